@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+An asyncio based scheduler for bio_switch, as an alternative to the thread in
+WorkingThread. Every run is a task on one event loop, so more channels or runs
+don't cost any more threads, and stopping a run cancels its task at once
+instead of waiting for a wake-up.
+
+This needs python 3.5+. The serial writes still go through the writer thread
+of each port (see RelayController.post()), which never blocks the loop.
+"""
+
+import time
+import asyncio
+import threading
+import concurrent.futures
+
+from bio_core import WorkingThread, SPIN_TIME, get_clock
+
+class AsyncEngine(WorkingThread):
+    """
+    Same start()/stop()/active_runs() surface as WorkingThread, so the GUI or
+    a headless runner can use either of them. All the bookkeeping of the runs
+    (event queue, journal, relay commands) is shared with WorkingThread, only
+    the waiting is done with coroutines.
+
+    If 'loop' is given, the runs are scheduled on it and the caller is in
+    charge of running it (see wait()). Otherwise the engine starts its own
+    loop in a background thread with the first run.
+    """
+    def __init__(self, logger, journal=None, notify=None, loop=None,
+                 event_log=None):
+        self.loop = loop
+        # the task of each run
+        self.tasks = {}
+        # the future each run task is waiting on, to wake it up
+        self.wakes = {}
+        WorkingThread.__init__(self, logger, journal, notify, event_log)
+
+    def schedule(self, run):
+        "get the new 'run' going, called with the lock held"
+        if not self.loop:
+            self.loop = asyncio.new_event_loop()
+            self.thread = threading.Thread(target=self.loop.run_forever)
+            self.thread.daemon = True
+            self.thread.start()
+        self.loop.call_soon_threadsafe(self.__spawn, run)
+
+    def wakeup(self):
+        """cancel the tasks of the runs that are stopping, and wake up the
+        others to look at their runs again (e.g. paused or resumed)"""
+        if self.loop:
+            self.loop.call_soon_threadsafe(self.__wake)
+
+    def __spawn(self, run):
+        self.tasks[run] = self.loop.create_task(self.__run_task(run))
+
+    def __wake(self):
+        for run, task in list(self.tasks.items()):
+            if run.stopping:
+                task.cancel()
+            elif run in self.wakes and not self.wakes[run].done():
+                self.wakes[run].set_result(None)
+
+    async def __run_task(self, run):
+        self.log("run '%s' started." % run.name)
+        try:
+            while not run.stopping and (run.paused is not None or
+                                        not run.events.empty()):
+                wake = self.wakes[run] = self.loop.create_future()
+                if run.paused is not None:
+                    await wake
+                    continue
+                deadline = run.next_deadline()
+                wait = deadline - get_clock()
+                if run.precise:
+                    # sleep coarsely, then spin for the last stretch
+                    wait -= SPIN_TIME
+                try:
+                    await asyncio.wait_for(wake, wait)
+                    # woken up, the run may have been changed
+                    continue
+                except asyncio.TimeoutError:
+                    pass
+                if run.precise:
+                    # spin in another thread, so that the other runs on the
+                    # loop are not held up meanwhile
+                    await self.loop.run_in_executor(None, self.spin, deadline)
+                self.handle_due(run)
+        except asyncio.CancelledError:
+            self.log("run '%s' cancelled." % run.name)
+        finally:
+            del self.tasks[run]
+            self.wakes.pop(run, None)
+            self.finish(run)
+
+    @staticmethod
+    def spin(deadline):
+        "busy-wait until clock 'deadline'"
+        while get_clock() < deadline:
+            # let the writer threads of the ports run
+            time.sleep(0)
+
+    async def wait(self):
+        "wait until all the runs are done, for a loop run by the caller"
+        # let the runs just started get their tasks first
+        await asyncio.sleep(0)
+        while self.tasks:
+            await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+
+    def wait_done(self, timeout=None):
+        """wait until all the runs are finished and their channels switched
+        off, from another thread than the one of the loop"""
+        if not self.loop or not self.loop.is_running():
+            return
+        done = asyncio.run_coroutine_threadsafe(self.wait(), self.loop)
+        try:
+            done.result(timeout)
+        except concurrent.futures.TimeoutError:
+            pass
+
+    def close(self):
+        "stop all the runs and the loop started by the engine"
+        if self.active_runs():
+            self.stop()
+        if self.thread:
+            # the cancelled runs switch their channels off in finish(), which
+            # needs the loop
+            self.wait_done()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.thread = None
@@ -0,0 +1,338 @@
+#!/usr/bin/python
+"""
+Command line runner of the bio relay controller, for machines without a
+display (e.g. under systemd). It only needs bio_core, so it starts fast and
+doesn't need wx at all:
+
+    bio_cli.py check config.conf
+    bio_cli.py run config.conf --port /dev/ttyUSB0
+    bio_cli.py simulate config.conf --trace trace.csv
+    bio_cli.py serve --socket /tmp/bio_switch.sock
+    bio_cli.py send --socket /tmp/bio_switch.sock '{"cmd": "status"}'
+
+See "bio_cli.py run -h" for the other options.
+"""
+
+import sys
+import time
+import json
+import signal
+import socket
+import datetime
+import threading
+import argparse
+
+import bio_core
+from bio_core import RunJournal, EventLog, RelayController, WorkingThread, \
+    check_config, config_hash, summarize_config, summarize_metrics, \
+    DEFAULT_PORT, JOURNAL_FILE, EVENT_LOG_FILE, TRACER, TRACE_FILE
+
+CONTROL_SOCKET = "/tmp/bio_switch.sock"
+
+def log(msg, name="main"):
+    print("%s: [%s] %s" % (datetime.datetime.now().ctime(), name, msg))
+    sys.stdout.flush()
+
+def start_profile(args):
+    "start tracing if --profile is given, see Tracer"
+    if args.profile:
+        TRACER.start(args.profile)
+
+def stop_profile():
+    path = TRACER.stop()
+    if path:
+        log("trace saved to '%s', open it in chrome://tracing." % path)
+
+def load_config(path):
+    "returns (config, source) of config file 'path', exits if it's wrong"
+    try:
+        f = open(path, "r")
+        source = f.read()
+        f.close()
+        config = check_config(json.loads(source))
+    except Exception as e:
+        log("failed to load config file '%s': %s" % (path, e))
+        sys.exit(1)
+    return config, source
+
+def open_event_log(args):
+    "the EventLog asked by --event-log, if any"
+    if not args.event_log:
+        return None
+    return EventLog(args.event_log, logger=log)
+
+def do_check(args):
+    config, source = load_config(args.config)
+    print(summarize_config(config))
+    return 0
+
+def do_run(args):
+    start_profile(args)
+    config, source = load_config(args.config)
+    if not args.dry_run:
+        bio_core.DEBUG = 0
+    journal = RunJournal(args.journal, log)
+    event_log = open_event_log(args)
+    offset = args.offset
+    if args.resume:
+        # continue the last unfinished run of the same config, if any
+        digest = config_hash(source)
+        for run in RunJournal.find_unfinished(args.journal):
+            if run["hash"] == digest:
+                log("resuming run %s at %s sec..." % (run["run"], run["resume"]))
+                offset = run["resume"]
+                journal.end(run["run"], "resumed")
+
+    done = threading.Event()
+    def notify():
+        if not engine.active_runs():
+            done.set()
+    if args.engine == "asyncio":
+        from bio_async import AsyncEngine
+        engine = AsyncEngine(log, journal, notify, event_log=event_log)
+    else:
+        engine = WorkingThread(log, journal, notify, event_log)
+    engine.compiled = args.compile
+    if not engine.start(config, args.port, offset, source, args.config):
+        journal.close()
+        if event_log:
+            event_log.close()
+        stop_profile()
+        return 1
+
+    def stop(signum, frame):
+        log("got signal %s, stopping..." % signum)
+        engine.stop()
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    # wait with a timeout, otherwise python 2 won't handle the signals
+    while not done.wait(1):
+        pass
+
+    log(summarize_metrics(engine.metrics()))
+    if args.engine == "asyncio":
+        engine.close()
+    journal.close()
+    if event_log:
+        event_log.close()
+    RelayController.close_all()
+    stop_profile()
+    return 0
+
+def do_simulate(args):
+    """run a config on simulated boards with a virtual clock, and print the
+    relay transitions"""
+    from bio_sim import Simulator, VirtualClock
+    start_profile(args)
+    config, source = load_config(args.config)
+    logger = log
+    if args.quiet:
+        logger = lambda msg, name="main": None
+    sim = Simulator(VirtualClock(args.speed))
+    sim.install()
+    event_log = open_event_log(args)
+    done = threading.Event()
+    def notify():
+        if not engine.active_runs():
+            done.set()
+    engine = WorkingThread(logger, None, notify, event_log, sim.clock)
+    engine.compiled = args.compile
+    started = time.time()
+    if not engine.start(config, args.port, args.offset, None, args.config):
+        return 1
+    def stop(signum, frame):
+        log("got signal %s, stopping..." % signum)
+        engine.stop()
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    while not done.wait(1):
+        pass
+    log(summarize_metrics(engine.metrics()))
+    RelayController.close_all()
+    stop_profile()
+    if event_log:
+        event_log.close()
+
+    trace = sim.trace()
+    log("simulated %.3f sec in %.3f sec, %s transitions" % \
+            (sim.clock.now(), time.time() - started, len(trace)))
+    f = sys.stdout
+    if args.trace:
+        f = open(args.trace, "w")
+    f.write("time,port,channel,state\n")
+    for item in trace:
+        f.write("%.6f,%s,%s,%s\n" % item)
+    if args.trace:
+        f.close()
+    return 0
+
+def do_fake_board(args):
+    "serve a simulated board on a pseudo terminal, until SIGTERM/SIGINT"
+    from bio_sim import PtyBoard
+    board = PtyBoard(log)
+    log("fake relay board on '%s'" % board.name)
+    done = threading.Event()
+    def stop(signum, frame):
+        done.set()
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    while not done.wait(1):
+        pass
+    board.close()
+    return 0
+
+def do_serve(args):
+    "run the runs asked over the control socket, until SIGTERM/SIGINT"
+    from bio_control import ControlServer
+    start_profile(args)
+    if not args.dry_run:
+        bio_core.DEBUG = 0
+    journal = RunJournal(args.journal, log)
+    event_log = open_event_log(args)
+    if args.engine == "asyncio":
+        from bio_async import AsyncEngine
+        engine = AsyncEngine(log, journal, event_log=event_log)
+    else:
+        engine = WorkingThread(log, journal, event_log=event_log)
+    engine.compiled = args.compile
+    server = ControlServer(engine, args.socket, log, args.port)
+    server.start()
+
+    done = threading.Event()
+    def stop(signum, frame):
+        log("got signal %s, stopping..." % signum)
+        done.set()
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    # wait with a timeout, otherwise python 2 won't handle the signals
+    while not done.wait(1):
+        pass
+
+    server.close()
+    if engine.active_runs():
+        engine.stop()
+    # the runs switch their channels off and end in the journal when they
+    # finish, before the journal and the ports are closed
+    engine.wait_done()
+    if args.engine == "asyncio":
+        engine.close()
+    journal.close()
+    if event_log:
+        event_log.close()
+    RelayController.close_all()
+    stop_profile()
+    return 0
+
+def do_send(args):
+    "send one request to the control socket and print the replies"
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(args.socket)
+    f = sock.makefile("rwb")
+    f.write((args.request.strip() + "\n").encode("utf-8"))
+    f.flush()
+    while True:
+        line = f.readline()
+        if not line:
+            break
+        print(line.decode("utf-8").strip())
+        sys.stdout.flush()
+        if "watch" not in args.request:
+            break
+    sock.close()
+    return 0
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Bio Relay Controller")
+    commands = parser.add_subparsers()
+    check = commands.add_parser("check", help="check a config file")
+    check.add_argument("config", help="the config file (*.conf)")
+    check.set_defaults(func=do_check)
+    run = commands.add_parser("run", help="run a config file")
+    run.add_argument("config", help="the config file (*.conf)")
+    run.add_argument("--port", default=DEFAULT_PORT,
+                     help="serial port of channels without their own "
+                          "(default: %(default)s)")
+    run.add_argument("--offset", type=float, default=0,
+                     help="start at this many seconds into the config")
+    run.add_argument("--resume", action="store_true",
+                     help="resume the unfinished run of this config in the "
+                          "journal, if there is one")
+    run.add_argument("--compile", action="store_true",
+                     help="compile the schedule into arrays (needs numpy)")
+    run.add_argument("--profile", nargs="?", const=TRACE_FILE,
+                     help="save timed spans of the run as a Chrome trace "
+                          "(default: %s)" % TRACE_FILE)
+    run.add_argument("--event-log", nargs="?", const=EVENT_LOG_FILE,
+                     help="log every relay transition into this CSV file "
+                          "(default: %s)" % EVENT_LOG_FILE)
+    run.add_argument("--journal", default=JOURNAL_FILE,
+                     help="the run journal file (default: %(default)s)")
+    run.add_argument("--engine", choices=["thread", "asyncio"],
+                     default="thread", help="the scheduler to use")
+    run.add_argument("--dry-run", action="store_true",
+                     help="don't really write to the serial ports")
+    run.set_defaults(func=do_run)
+    simulate = commands.add_parser("simulate", help="run a config on "
+                                   "simulated relays in virtual time")
+    simulate.add_argument("config", help="the config file (*.conf)")
+    simulate.add_argument("--speed", type=float,
+                          help="run this many times faster than real time "
+                               "(default: as fast as possible)")
+    simulate.add_argument("--port", default=DEFAULT_PORT,
+                          help="serial port of channels without their own "
+                               "(default: %(default)s)")
+    simulate.add_argument("--offset", type=float, default=0,
+                          help="start at this many seconds into the config")
+    simulate.add_argument("--trace",
+                          help="write the relay transitions into this CSV "
+                               "file instead of stdout")
+    simulate.add_argument("--compile", action="store_true",
+                          help="compile the schedule into arrays (needs numpy)")
+    simulate.add_argument("--profile", nargs="?", const=TRACE_FILE,
+                          help="save timed spans of the run as a Chrome trace "
+                               "(default: %s)" % TRACE_FILE)
+    simulate.add_argument("--event-log", nargs="?", const=EVENT_LOG_FILE,
+                          help="log every relay transition into this CSV file "
+                               "(default: %s)" % EVENT_LOG_FILE)
+    simulate.add_argument("--quiet", action="store_true",
+                          help="don't log the events")
+    simulate.set_defaults(func=do_simulate)
+    fake = commands.add_parser("fake-board", help="serve a simulated relay "
+                               "board on a pseudo terminal")
+    fake.set_defaults(func=do_fake_board)
+    serve = commands.add_parser("serve", help="serve the control socket")
+    serve.add_argument("--socket", default=CONTROL_SOCKET,
+                       help="the control socket (default: %(default)s)")
+    serve.add_argument("--port", default=DEFAULT_PORT,
+                       help="serial port of channels without their own "
+                            "(default: %(default)s)")
+    serve.add_argument("--compile", action="store_true",
+                       help="compile the schedule into arrays (needs numpy)")
+    serve.add_argument("--profile", nargs="?", const=TRACE_FILE,
+                       help="save timed spans of the run as a Chrome trace "
+                            "(default: %s)" % TRACE_FILE)
+    serve.add_argument("--event-log", nargs="?", const=EVENT_LOG_FILE,
+                       help="log every relay transition into this CSV file "
+                            "(default: %s)" % EVENT_LOG_FILE)
+    serve.add_argument("--journal", default=JOURNAL_FILE,
+                       help="the run journal file (default: %(default)s)")
+    serve.add_argument("--engine", choices=["thread", "asyncio"],
+                       default="thread", help="the scheduler to use")
+    serve.add_argument("--dry-run", action="store_true",
+                       help="don't really write to the serial ports")
+    serve.set_defaults(func=do_serve)
+    send = commands.add_parser("send", help="send a request to the control "
+                               "socket, see bio_control.py")
+    send.add_argument("--socket", default=CONTROL_SOCKET,
+                      help="the control socket (default: %(default)s)")
+    send.add_argument("request", help="the request in JSON")
+    send.set_defaults(func=do_send)
+    args = parser.parse_args(argv)
+    if not hasattr(args, "func"):
+        # python 3 doesn't require a sub-command
+        parser.print_help()
+        return 1
+    return args.func(args)
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,184 @@
+#!/usr/bin/python
+"""
+A small control server over a Unix domain socket, to script and monitor the
+runs of a scheduler (WorkingThread or AsyncEngine) from other programs.
+
+Each request is one JSON hash per line, and each reply is one JSON hash per
+line with "ok" set to true, or false with an "error" message:
+
+    {"cmd": "load", "path": "a.conf"}           load a config file, or
+    {"cmd": "load", "name": "a", "config": {}}  a config hash
+    {"cmd": "start", "name": "a", "port": "/dev/ttyUSB0", "offset": 0}
+    {"cmd": "stop", "run": 1}                   stop run 1, or all runs
+    {"cmd": "pause", "run": 1}
+    {"cmd": "resume", "run": 1, "offset": 60}   "offset" is optional
+    {"cmd": "status"}                           status of all the runs
+    {"cmd": "metrics"}                          counters of the scheduler
+    {"cmd": "trace", "on": true, "path": "x.json"}
+                                                start/stop tracing the runs
+    {"cmd": "watch", "interval": 1}             status every "interval" sec
+
+Every client is served by its own thread, and the status is only read from
+the runs, so polling never delays the relays.
+"""
+
+import os
+import json
+import time
+import threading
+try:
+    import SocketServer as socketserver
+except ImportError:
+    # python 3
+    import socketserver
+
+from bio_core import ConfigCache, check_config, DEFAULT_PORT, TRACER, \
+    TRACE_FILE
+
+class ControlHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            try:
+                request = json.loads(line.decode("utf-8"))
+                if request.get("cmd") == "watch":
+                    self.watch(float(request.get("interval", 1)))
+                    return
+                reply = self.server.handle_command(request)
+            except Exception as e:
+                reply = {"ok": False, "error": str(e)}
+            if not self.send(reply):
+                return
+
+    def send(self, reply):
+        "send a reply, returns False if the client has gone"
+        try:
+            self.wfile.write((json.dumps(reply) + "\n").encode("utf-8"))
+            self.wfile.flush()
+        except (IOError, OSError):
+            return False
+        return True
+
+    def watch(self, interval):
+        while self.send(self.server.status()):
+            time.sleep(interval)
+
+    def finish(self):
+        try:
+            socketserver.StreamRequestHandler.finish(self)
+        except (IOError, OSError):
+            # the client has gone
+            pass
+
+class ControlServer(socketserver.ThreadingMixIn,
+                    socketserver.UnixStreamServer):
+    """
+    Serves the control requests of 'engine' on Unix socket 'path'. The loaded
+    configs are kept by name for "start".
+    """
+    daemon_threads = True
+
+    def __init__(self, engine, path, logger, port=DEFAULT_PORT):
+        if os.path.exists(path):
+            # left by a server that has not quit cleanly
+            os.unlink(path)
+        socketserver.UnixStreamServer.__init__(self, path, ControlHandler)
+        self.engine = engine
+        self.path = path
+        self.logger = logger
+        self.port = port
+        # loaded configs: name -> (config, source)
+        self.configs = {}
+        # config files loaded by "path", parsed again only when they change
+        self.cache = ConfigCache()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def log(self, msg):
+        self.logger(msg, name="control")
+
+    def start(self):
+        "serve in a background thread"
+        self.log("listening on '%s'..." % self.path)
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+        os.unlink(self.path)
+
+    def find_run(self, request):
+        "the run asked by 'request', None for all the runs"
+        if request.get("run") is None:
+            return None
+        for run in self.engine.active_runs():
+            if run.id == request["run"]:
+                return run
+        raise Exception("no such run: %s" % request["run"])
+
+    def status(self):
+        return {"ok": True, "time": time.time(),
+                "runs": [run.status() for run in self.engine.active_runs()]}
+
+    def handle_command(self, request):
+        cmd = request.get("cmd")
+        if cmd == "load":
+            if "path" in request:
+                config, source = self.cache.load(request["path"])
+                name = request.get("name", request["path"])
+            else:
+                source = json.dumps(request["config"])
+                name = request["name"]
+                config = check_config(json.loads(source))
+            self.lock.acquire()
+            try:
+                self.configs[name] = (config, source)
+            finally:
+                self.lock.release()
+            self.log("config '%s' loaded." % name)
+            return {"ok": True, "name": name}
+        elif cmd == "start":
+            name = request["name"]
+            self.lock.acquire()
+            try:
+                if name not in self.configs:
+                    raise Exception("config '%s' is not loaded" % name)
+                config, source = self.configs[name]
+            finally:
+                self.lock.release()
+            run = self.engine.start(config, request.get("port", self.port),
+                                    request.get("offset", 0), source, name)
+            if not run:
+                raise Exception("failed to start '%s', please check the log"
+                                % name)
+            return {"ok": True, "run": run.id}
+        elif cmd == "stop":
+            self.engine.stop(self.find_run(request))
+            return {"ok": True}
+        elif cmd in ("pause", "resume"):
+            run = self.find_run(request)
+            if not run:
+                raise Exception("'%s' needs a run" % cmd)
+            if cmd == "pause":
+                self.engine.pause(run)
+            else:
+                self.engine.resume(run, request.get("offset"))
+            return {"ok": True}
+        elif cmd == "status":
+            return self.status()
+        elif cmd == "metrics":
+            return {"ok": True, "metrics": self.engine.metrics()}
+        elif cmd == "trace":
+            if request.get("on", True):
+                TRACER.start(request.get("path", TRACE_FILE))
+                self.log("tracing started.")
+                return {"ok": True}
+            path = TRACER.stop()
+            if path:
+                self.log("trace saved to '%s'." % path)
+            return {"ok": True, "path": path}
+        raise Exception("unknown command: %s" % cmd)
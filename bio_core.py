@@ -0,0 +1,1738 @@
+#!/usr/bin/python
+"""
+The core of the bio relay controller: signals, the scheduler and the relay
+boards. It doesn't need wx, so it can be used by the GUI (bio_switch.py) as
+well as the command line runner (bio_cli.py). PySerial is only imported when a
+serial port is really opened.
+"""
+
+import os
+import sys
+import json
+import datetime
+import threading
+import time
+import struct
+import heapq
+import bisect
+import hashlib
+try:
+    import Queue
+except ImportError:
+    # python 3
+    import queue as Queue
+
+OS_TYPE=sys.platform            # can be 'darwin'
+MAX_CHANNEL_N = 8
+JOURNAL_FILE="run_journal.bio_log"
+# how often (in seconds) the journal is synced to disk at most
+JOURNAL_SYNC_TIME = 1.0
+# how often (in seconds) the progress of the runs is recorded in the journal
+JOURNAL_PROGRESS_TIME = 10.0
+EVENT_LOG_FILE="events.csv"
+# the event log is rotated when it grows bigger than this, and this many old
+# logs are kept (as events.csv.1, events.csv.2, ...)
+EVENT_LOG_SIZE = 10 * 1024 * 1024
+EVENT_LOG_COUNT = 5
+TRACE_FILE = "bio_trace.json"
+# a trace keeps at most this many spans, the later ones are dropped
+TRACE_MAX_SPANS = 1000000
+# upper bounds (in seconds) of the buckets of a Histogram
+HISTOGRAM_BOUNDS = [1e-6 * 2 ** i for i in range(28)]
+# in precise mode, the working thread busy-waits this long (in seconds) before
+# each event instead of sleeping
+SPIN_TIME = 0.02
+# set this if we don't want to really control the relay, but only test the logic
+DEBUG = 1
+
+# set default serial port
+DEFAULT_PORT_LIST = {"darwin": "/dev/tty.usbserial", "win32": "COM1",
+                     "linux": "/dev/ttyUSB0"}
+if OS_TYPE.startswith("linux"):
+    # python 2 says 'linux2'
+    DEFAULT_PORT = DEFAULT_PORT_LIST["linux"]
+else:
+    DEFAULT_PORT = DEFAULT_PORT_LIST.get(OS_TYPE, "")
+
+# use a monotonic clock when there is one (python 3.3+), so that adjusting the
+# system time during a long run won't shift the events
+if hasattr(time, "monotonic"):
+    get_clock = time.monotonic
+else:
+    get_clock = time.time
+
+# python 2/3 compatibility
+if sys.version_info[0] >= 3:
+    INT_TYPES = (int,)
+    STRING_TYPES = (str,)
+else:
+    INT_TYPES = (int, long)
+    STRING_TYPES = (basestring,)
+
+class Signal(object):
+    """
+    A signal is a so-called signal with a time axis and a value. One signal can
+    be inited in two ways:
+
+    1. atomic signal: "length" and "state" are required. It defines a static
+       signal with state and which holds a specific length (in seconds, can
+       be fractional).
+    2. combined signal: "sub_signals" is required. "cycle" is optional to
+       describe that how many times the combined signal will be replayed. The
+       default value of "cycle" is set to 1, which is only once.
+
+    attributes for a signal:
+    - config: the hash representation
+
+    Signals can't be changed once created, so a signal can be a sub-signal
+    of many others (and be shared by many runs) without being copied.
+    """
+    __slots__ = ("length", "state", "sub_signals", "cycle", "__type",
+                 "__period", "__total", "__count", "__first", "__last",
+                 "__changes", "__on", "__frozen")
+
+    def __init__ (self, length=-1, state=-1, sub_signals=[], cycle=1):
+        if length != -1 and state != -1:
+            # this is an atomic signal
+            self.__type = "atomic"
+            if type(length) not in INT_TYPES + (float,):
+                self.err("length (%s) should be digital" % length)
+            if length <= 0:
+                self.err("length (%s) should be greater than zero" % length)
+            if type(state) != type(1):
+                self.err("state (%s) should be digital" % state)
+            self.length = length
+            self.state = state
+            # summary of the signal, see __summarize()
+            self.__total = length
+            self.__count = 1
+            self.__first = self.__last = state
+            self.__changes = 0
+            self.__on = (0, length)
+        elif sub_signals and cycle:
+            # this is a combined signal
+            self.__type = "combined"
+            if type(cycle) not in INT_TYPES:
+                self.err("cycle (%s) should be digital" % cycle)
+            # each of the sub-signal should be another signal instance
+            for sig in sub_signals:
+                if not isinstance(sig, Signal):
+                    self.err("item '%s' is not Signal" % sig)
+            self.sub_signals = tuple(sub_signals)
+            self.cycle = cycle
+            self.__summarize()
+        else:
+            self.err("Failed to init Signal instance, param not right")
+        self.__frozen = True
+
+    def __setattr__ (self, name, value):
+        if getattr(self, "_Signal__frozen", False):
+            raise AttributeError("Signal can't be changed")
+        object.__setattr__(self, name, value)
+
+    def __delattr__ (self, name):
+        raise AttributeError("Signal can't be changed")
+
+    def __copy__ (self):
+        return self
+
+    def __deepcopy__ (self, memo):
+        # nothing to copy for an immutable object
+        return self
+
+    def __summarize (self):
+        """Calculate the summary of a combined signal from its sub-signals, so
+        that the analytics below never need to expand the cycles:
+        - __period: length of one cycle
+        - __total: length of the whole signal
+        - __count: number of events
+        - __first/__last: state of the first/last event
+        - __changes: number of state changes between the events
+        - __on: time spent in a non-zero state, as a tuple for a previous state
+          of zero and non-zero"""
+        subs = self.sub_signals
+        period = 0
+        count = 0
+        changes = 0
+        on_off = 0
+        on_on = 0
+        prev = None
+        for sig in subs:
+            period += sig.__total
+            count += sig.__count
+            changes += sig.__changes
+            if prev is None:
+                on_off += sig.__on[0]
+                on_on += sig.__on[1]
+            else:
+                if prev != sig.__first:
+                    changes += 1
+                on_off += sig.__on[bool(prev)]
+                on_on += sig.__on[bool(prev)]
+            prev = sig.__last
+        self.__period = period
+        self.__total = period * self.cycle
+        self.__count = count * self.cycle
+        self.__first = subs[0].__first
+        self.__last = subs[-1].__last
+        self.__changes = changes * self.cycle
+        if self.__first != self.__last:
+            self.__changes += self.cycle - 1
+        # the first cycle follows the previous state, the others follow the
+        # last state of the cycle before
+        rest = (self.cycle - 1) * (on_on if self.__last else on_off)
+        self.__on = (on_off + rest, on_on + rest)
+
+    def is_atomic (self):
+        return self.__type == "atomic"
+
+    def total_length (self):
+        "the length of the whole signal in seconds"
+        return self.__total
+
+    def event_count (self):
+        "how many events (atomic signals) the signal will generate"
+        return self.__count
+
+    def transition_count (self, initial=0):
+        """how many times the state really changes, starting from state
+        'initial' before the first event"""
+        return self.__changes + int(initial != self.__first)
+
+    def duty_cycle (self, initial=0):
+        """the ratio of time that the state is non-zero during the signal,
+        starting from state 'initial'. Each state holds until the next event"""
+        return float(self.__on[bool(initial)]) / self.__total
+
+    def state_at (self, offset, initial=0):
+        """the state at 'offset' seconds after the signal starts. An event
+        happening exactly at 'offset' is counted. Returns 'initial' if there
+        is no event yet."""
+        state = self.__state_at(offset)
+        if state is None:
+            return initial
+        return state
+
+    def __state_at (self, offset):
+        "like state_at(), but returns None if there is no event yet"
+        if offset >= self.__total:
+            return self.__last
+        if self.__type == "atomic":
+            return None
+        # skip the whole cycles before offset
+        cycles = int(offset // self.__period)
+        offset -= cycles * self.__period
+        prev = None
+        if cycles > 0:
+            prev = self.__last
+        for sig in self.sub_signals:
+            if offset < sig.__total:
+                state = sig.__state_at(offset)
+                if state is None:
+                    return prev
+                return state
+            offset -= sig.__total
+            prev = sig.__last
+        return prev
+
+    def __iterAtomic (self, start, after):
+        if self.length > after:
+            yield {"length": self.length + start, "state": self.state}
+
+    def __iterCombined (self, start, after):
+        first = 0
+        if after > 0:
+            if after >= self.__total:
+                return
+            # jump over the whole cycles before 'after' directly
+            first = int(after // self.__period)
+            start += first * self.__period
+            after -= first * self.__period
+        # not using xrange() here since cycle can be too big for it
+        i = first
+        while i < self.cycle:
+            i += 1
+            for signal in self.sub_signals:
+                if after >= signal.__total:
+                    # this sub-signal is all before 'after', skip it
+                    start += signal.__total
+                    after -= signal.__total
+                    continue
+                for event in signal.iter_events(start, after):
+                    yield event
+                    # update the start for next signal
+                    start = event["length"]
+                after = 0
+
+    def __str__ (self):
+        if self.__type == "atomic":
+            return "<Signal(atomic): length=%s,state=%s>" % \
+                (self.length, self.state)
+        elif self.__type == "combined":
+            result = "<Signal(combined,cycle=%s):\n" % self.cycle
+            for signal in self.sub_signals:
+                sub_result = str(signal)
+                for line in sub_result.split("\n"):
+                    result += "  " + line + "\n"
+            return result.strip() + ">"
+
+    def err (self, s):
+        self.err(s)
+
+    def iter_events (self, start=0, after=0):
+        """Lazily generate the events of this signal in time order, one at a
+        time. This is the same as dump() but never builds the whole list, so
+        memory only grows with the nesting depth, not with the cycles. param
+        'start' is the starting timestamp. If 'after' is set, only the events
+        happening later than 'after' seconds into the signal are generated,
+        and the ones before are skipped without being expanded."""
+        if self.__type == "atomic":
+            return self.__iterAtomic(start, after)
+        elif self.__type == "combined":
+            return self.__iterCombined(start, after)
+        else:
+            self.err("unknown signal type: " + str(self.__type))
+
+    def dump (self, start=0):
+        """Dump this signal into an array that describes the signal. param
+        'start' is the starting timestamp."""
+        started = TRACER.enabled and TRACER.now()
+        events = list(self.iter_events(start))
+        if started:
+            TRACER.add("Signal.dump", started, {"events": len(events)})
+        return events
+
+    @staticmethod
+    def parseFromHash (config, interned=None):
+        """This is a static method for Signal class to generate a Signal
+        instance using an hash like this:
+        {
+            "sub_signals": [
+                {
+                    "length": 20,
+                    "state": 1
+                },
+                {
+                    "length": 10,
+                    "state": 0
+                },
+                {
+                    "length": 15,
+                    "state": 1
+                }
+            ],
+            "cycle": 3
+        }
+        or a simple atomic signal:
+        {
+            "length": 50,
+            "state": 1
+        }
+        or a really complex looped-define signal:
+        {
+            "sub_signals": [
+                {
+                    "sub_signals": [
+                        {
+                            "length": 30,
+                            "state": 0
+                        },
+                        {
+                            "length": 20,
+                            "state": 1
+                        },
+                    ],
+                    "cycle": 2
+                },
+                {
+                    "length": 10,
+                    "state": 0
+                }
+            ],
+            "cycle": 3
+        }
+
+        Identical sub-signals are only created once and shared. 'interned'
+        is the hash to look them up in, pass the same one to share them
+        between several calls.
+        """
+        if interned is None:
+            interned = {}
+        if type(config) != type({}):
+            raise Exception("type of 'config' not right (should be hash)")
+        # the same hash may be used many times in a generated config
+        if id(config) in interned:
+            return interned[id(config)][1]
+        signal = Signal.__parse(config, interned)
+        # keep the hash so that its id is not reused for another one
+        interned[id(config)] = (config, signal)
+        return signal
+
+    @staticmethod
+    def __parse (config, interned):
+        if "length" in config and "state" in config:
+            # this is a normal atomic signal. 1 and 1.0 are equal keys, but
+            # their events are not printed the same
+            key = ("atomic", config["length"], type(config["length"]),
+                   config["state"], type(config["state"]))
+            if key not in interned:
+                interned[key] = Signal(length=config["length"],
+                                       state=config["state"])
+            return interned[key]
+        elif "sub_signals" in config:
+            # this should be a combined signal
+            if "cycle" in config:
+                cycle = config["cycle"]
+            else:
+                # this is the default
+                cycle = 1
+            sig_list = []
+            sub_signals = config["sub_signals"]
+            if type(sub_signals) != type([]):
+                raise Exception("sub_signals (%s) should be a array like: [...]"\
+                             % sub_signals)
+            for signal in sub_signals:
+                sig = Signal.parseFromHash(signal, interned)
+                sig_list.append(sig)
+            # the sub-signals are interned already, so comparing them by
+            # identity is enough
+            key = ("combined", cycle, type(cycle),
+                   tuple([id(x) for x in sig_list]))
+            if key not in interned:
+                interned[key] = Signal(sub_signals=sig_list, cycle=cycle)
+            return interned[key]
+        else:
+            raise Exception("we need 'sub_signals/cycle' or 'length/state'")
+
+class EventQueue():
+    """
+    A k-way merge of several lazy event streams (one per channel) in time
+    order. Only the head event of each stream is kept in a heap, so both the
+    setup cost and the memory do not depend on how long the run is.
+
+    Events with the same timestamp are ordered by the order in which their
+    streams were added, so the result is always deterministic.
+    """
+    def __init__ (self):
+        self.heap = []
+        self.streams = 0
+
+    def add_stream (self, events):
+        "add one time-ordered event iterator into the queue"
+        index = self.streams
+        self.streams += 1
+        self.__push(index, iter(events))
+
+    def __push (self, index, iterator):
+        for event in iterator:
+            heapq.heappush(self.heap, (event["length"], index, event, iterator))
+            return
+
+    def empty (self):
+        return len(self.heap) == 0
+
+    def __len__ (self):
+        "number of streams that still have pending events"
+        return len(self.heap)
+
+    def peek (self):
+        "return the next event without removing it, None if empty"
+        if not self.heap:
+            return None
+        return self.heap[0][2]
+
+    def pop (self):
+        "remove and return the next event, pulling a new one from its stream"
+        length, index, event, iterator = heapq.heappop(self.heap)
+        self.__push(index, iterator)
+        return event
+
+def close_quietly(f):
+    "close file 'f' if any, ignoring the errors. Returns None"
+    if f is not None:
+        try:
+            f.close()
+        except (IOError, OSError):
+            pass
+    return None
+
+def config_hash(source):
+    """sha1 hex digest of config text 'source', read from a file (bytes on
+    python 2) or typed into the GUI (unicode)"""
+    if not isinstance(source, bytes):
+        source = source.encode("utf-8")
+    return hashlib.sha1(source).hexdigest()
+
+class RunJournal():
+    """
+    An append-only journal of the runs, one JSON record per line:
+
+    {"type": "start", "run": id, "hash": config hash, "config": config text,
+     "port": port, "offset": offset, "name": name, "time": wall time}
+    {"type": "event", "run": id, "name": name, "channel": channel,
+     "state": state, "planned": planned time, "actual": actual time}
+    {"type": "progress", "run": id, "offset": offset}
+    {"type": "end", "run": id, "reason": reason, "time": wall time}
+
+    "planned", "actual" and "offset" are seconds into the config. The
+    progress of the runs being watched (see watch()) is recorded every
+    JOURNAL_PROGRESS_TIME seconds, as a run may have no event for hours. The
+    records are
+    written and fsync()ed in batches by a background thread, so appending a
+    record only costs a queue put. A run without an "end" record was
+    interrupted and can be resumed, see find_unfinished(). Errors writing
+    the file are told to 'logger', and the writer goes on with the next
+    records.
+    """
+    def __init__ (self, path=JOURNAL_FILE, logger=None):
+        self.path = path
+        self.logger = logger
+        self.queue = Queue.Queue()
+        # run id -> [function giving its offset, last offset recorded]
+        self.watched = {}
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.__writer)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def log (self, msg):
+        if self.logger:
+            self.logger(msg, name="journal")
+        else:
+            sys.stderr.write(msg + "\n")
+
+    def __progress (self):
+        "the progress records of the watched runs which went on"
+        records = []
+        self.lock.acquire()
+        try:
+            for run, watch in self.watched.items():
+                offset = watch[0]()
+                if offset != watch[1]:
+                    watch[1] = offset
+                    records.append({"type": "progress", "run": run,
+                                    "offset": offset})
+        finally:
+            self.lock.release()
+        return records
+
+    def __writer (self):
+        f = None
+        dirty = False
+        last_sync = last_progress = get_clock()
+        while True:
+            try:
+                records = [self.queue.get(timeout=JOURNAL_SYNC_TIME)]
+            except Queue.Empty:
+                records = []
+            # take everything pending in one go
+            while True:
+                try:
+                    records.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            if get_clock() - last_progress >= JOURNAL_PROGRESS_TIME:
+                records[:0] = self.__progress()
+                last_progress = get_clock()
+            done = None in records
+            try:
+                if records:
+                    if f is None:
+                        f = open(self.path, "a")
+                    for record in records:
+                        if record is not None:
+                            f.write(json.dumps(record) + "\n")
+                    f.flush()
+                    dirty = True
+                if dirty and (done or not records or
+                              get_clock() - last_sync >= JOURNAL_SYNC_TIME):
+                    os.fsync(f.fileno())
+                    dirty = False
+                    last_sync = get_clock()
+            except (IOError, OSError) as e:
+                # the records are lost, but not the later ones
+                self.log("failed to write journal '%s': %s" % (self.path, e))
+                f = close_quietly(f)
+                dirty = False
+            if done:
+                close_quietly(f)
+                return
+
+    def append (self, record):
+        self.queue.put(record)
+
+    def begin (self, source, port, offset=0, name=""):
+        "record the start of a run of config text 'source', returns run id"
+        digest = config_hash(source)
+        run = "%s-%s" % (datetime.datetime.now().strftime("%Y%m%d%H%M%S%f"),
+                         digest[:8])
+        self.append({"type": "start", "run": run, "hash": digest,
+                     "config": source, "port": port, "offset": offset,
+                     "name": name, "time": time.time()})
+        return run
+
+    def event (self, run, event):
+        self.append({"type": "event", "run": run, "name": event["name"],
+                     "port": event["port"], "channel": event["channel"],
+                     "state": event["state"],
+                     "planned": event["length"],
+                     "actual": event["length"] + event["late"]})
+
+    def watch (self, run, offset):
+        """record the progress of 'run' from now on, 'offset' is a function
+        giving how many seconds into its config the run is"""
+        self.lock.acquire()
+        try:
+            self.watched[run] = [offset, None]
+        finally:
+            self.lock.release()
+
+    def end (self, run, reason):
+        self.lock.acquire()
+        try:
+            self.watched.pop(run, None)
+        finally:
+            self.lock.release()
+        self.append({"type": "end", "run": run, "reason": reason,
+                     "time": time.time()})
+
+    def close (self):
+        "write all the pending records and stop the writer"
+        self.queue.put(None)
+        self.thread.join()
+
+    @staticmethod
+    def find_unfinished (path=JOURNAL_FILE):
+        """Find the runs in journal 'path' that have not ended. Returns their
+        "start" records with an extra "resume" entry (the offset of the last
+        progress or event record), in the order they were started."""
+        if not os.path.isfile(path):
+            return []
+        runs = {}
+        order = []
+        f = open(path, "r")
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # the last line may be broken by the crash
+                continue
+            if record["type"] == "start":
+                record["resume"] = record["offset"]
+                runs[record["run"]] = record
+                order.append(record["run"])
+            elif record["run"] not in runs:
+                continue
+            elif record["type"] == "event":
+                runs[record["run"]]["resume"] = record["planned"]
+            elif record["type"] == "progress":
+                runs[record["run"]]["resume"] = record["offset"]
+            elif record["type"] == "end":
+                del runs[record["run"]]
+        f.close()
+        return [runs[x] for x in order if x in runs]
+
+class Tracer():
+    """
+    Timed spans of the phases of a run (parsing, expanding, scheduling,
+    sending, logging), saved as a Chrome trace which can be loaded into
+    chrome://tracing or https://ui.perfetto.dev. It's off unless start() is
+    called, and can be started/stopped at any time. The spans are added like
+    this, which costs next to nothing when the tracer is off:
+
+        started = TRACER.enabled and TRACER.now()
+        ...
+        if started:
+            TRACER.add("phase", started)
+    """
+    def __init__ (self):
+        self.enabled = False
+        self.path = None
+        self.spans = []
+        self.dropped = 0
+        # threads already named in the trace
+        self.threads = set()
+
+    def now (self):
+        "timestamp (in microseconds) for the spans"
+        return get_clock() * 1e6
+
+    def start (self, path=TRACE_FILE):
+        self.path = path
+        self.spans = []
+        self.dropped = 0
+        self.threads = set()
+        self.enabled = True
+
+    def stop (self):
+        "stop tracing and save the trace, returns the path of the file"
+        if not self.enabled:
+            return None
+        self.enabled = False
+        f = open(self.path, "w")
+        f.write(json.dumps({"traceEvents": self.spans,
+                            "otherData": {"dropped": self.dropped}}))
+        f.close()
+        self.spans = []
+        return self.path
+
+    def add (self, name, started, args=None):
+        "add span 'name' from 'started' (see now()) until now"
+        if not self.enabled:
+            return
+        if len(self.spans) >= TRACE_MAX_SPANS:
+            self.dropped += 1
+            return
+        thread = threading.current_thread()
+        if thread.ident not in self.threads:
+            self.threads.add(thread.ident)
+            self.spans.append({"name": "thread_name", "ph": "M",
+                               "pid": os.getpid(), "tid": thread.ident,
+                               "args": {"name": thread.name}})
+        span = {"name": name, "ph": "X", "ts": started,
+                "dur": self.now() - started, "pid": os.getpid(),
+                "tid": thread.ident}
+        if args:
+            span["args"] = args
+        # list.append() is atomic, so no lock is needed between the threads
+        self.spans.append(span)
+
+# the tracer of this process
+TRACER = Tracer()
+
+class Histogram():
+    """
+    Counts values (in seconds) into buckets of powers of 2 from 1us to about
+    2 minutes (see HISTOGRAM_BOUNDS), cheap enough to be added to for every
+    event. Percentiles are only as precise as the buckets, i.e. within a
+    factor of 2.
+    """
+    def __init__ (self):
+        # the last bucket is for everything bigger than the bounds
+        self.counts = [0] * (len(HISTOGRAM_BOUNDS) + 1)
+        self.total = 0.0
+        self.max = 0.0
+
+    def add (self, value):
+        # keep this short, it's called for every event and every write
+        self.counts[bisect.bisect_left(HISTOGRAM_BOUNDS, value)] += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def count (self):
+        return sum(self.counts)
+
+    def merge (self, other):
+        "add all the values of histogram 'other' into this one"
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile (self, p):
+        "the value that 'p' percent of the values are not bigger than"
+        want = self.count() * p / 100.0
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= want:
+                if i < len(HISTOGRAM_BOUNDS):
+                    return min(HISTOGRAM_BOUNDS[i], self.max)
+                break
+        return self.max
+
+    def snapshot (self):
+        count = self.count()
+        return {"count": count, "mean": count and self.total / count,
+                "p50": self.percentile(50), "p99": self.percentile(99),
+                "max": self.max}
+
+class Clock():
+    """
+    The clock of a scheduler, which is the real one (see get_clock) unless
+    the scheduler is given another one, e.g. bio_sim.VirtualClock to run the
+    configs in simulated time.
+    """
+    # busy-waiting for a precise run only makes sense on the real clock
+    real = True
+
+    def now (self):
+        return get_clock()
+
+    def wait_until (self, event, deadline):
+        """wait until 'deadline' (see now()) or until 'event' is set, returns
+        True if 'event' is set. If 'deadline' is None, wait for the event."""
+        if deadline is None:
+            event.wait()
+            return True
+        return event.wait(deadline - get_clock()) == True
+
+class EventLog():
+    """
+    A CSV log of every relay transition, for the lab notebooks. The columns
+    are EventLog.COLUMNS:
+
+    - wall_time/clock: time.time() and the clock of the run (see Clock) when
+      the event was sent
+    - run: name of the run
+    - planned: seconds into the config the event was planned at
+    - name/port/channel/state: the channel and its new state
+    - late: how late (in seconds) the event was sent
+
+    append() only puts the event into a queue. A background thread formats
+    and writes them in batches, and rotates the file when it's bigger than
+    'size' bytes, keeping 'count' old ones. Errors writing the file are told
+    to 'logger', and the writer goes on with the next events.
+    """
+    COLUMNS = ["wall_time", "clock", "run", "planned", "name", "port",
+               "channel", "state", "late"]
+
+    def __init__ (self, path=EVENT_LOG_FILE, size=EVENT_LOG_SIZE,
+                  count=EVENT_LOG_COUNT, logger=None):
+        self.path = path
+        self.logger = logger
+        self.size = size
+        self.count = count
+        self.queue = Queue.Queue()
+        self.thread = threading.Thread(target=self.__writer)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def append (self, run, event):
+        self.queue.put((time.time(), run.clock.now(), run.name, event))
+
+    def close (self):
+        "write all the pending events and stop the writer"
+        self.queue.put(None)
+        self.thread.join()
+
+    def log (self, msg):
+        if self.logger:
+            self.logger(msg, name="events")
+        else:
+            sys.stderr.write(msg + "\n")
+
+    @staticmethod
+    def quote (value):
+        return '"%s"' % ("%s" % value).replace('"', '""')
+
+    def format (self, record):
+        wall_time, clock, run, event = record
+        return "%.6f,%.6f,%s,%s,%s,%s,%s,%s,%.6f\n" % \
+            (wall_time, clock, EventLog.quote(run), event["length"],
+             EventLog.quote(event["name"]), EventLog.quote(event["port"]),
+             event["channel"], event["state"], event["late"])
+
+    def __open (self):
+        f = open(self.path, "a")
+        if f.tell() == 0:
+            f.write(",".join(EventLog.COLUMNS) + "\n")
+        return f
+
+    def __rotate (self):
+        "events.csv -> events.csv.1 -> events.csv.2 ..."
+        # rename() can't replace a file on windows
+        oldest = "%s.%s" % (self.path, self.count)
+        if self.count > 0 and os.path.exists(oldest):
+            os.unlink(oldest)
+        for i in range(self.count - 1, 0, -1):
+            old = "%s.%s" % (self.path, i)
+            if os.path.exists(old):
+                os.rename(old, "%s.%s" % (self.path, i + 1))
+        if self.count > 0:
+            os.rename(self.path, self.path + ".1")
+        else:
+            os.unlink(self.path)
+
+    def __writer (self):
+        f = None
+        while True:
+            records = [self.queue.get()]
+            # take everything pending in one go
+            while True:
+                try:
+                    records.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            done = records[-1] is None
+            try:
+                if f is None:
+                    f = self.__open()
+                f.write("".join([self.format(x) for x in records if x]))
+                f.flush()
+                if not done and f.tell() > self.size:
+                    f = close_quietly(f)
+                    self.__rotate()
+            except (IOError, OSError) as e:
+                # the events are lost, but not the later ones
+                self.log("failed to write event log '%s': %s" % \
+                             (self.path, e))
+                f = close_quietly(f)
+            if done:
+                close_quietly(f)
+                return
+
+class RelayController():
+    # the packed frame of each (channel, value), see frame()
+    FRAMES = {}
+    for channel in range(1, MAX_CHANNEL_N + 1):
+        for value in range(2):
+            FRAMES[(channel, value)] = struct.pack("5B", 0xFF, channel, value,
+                                                   channel + value, 0xEE)
+    del channel, value
+
+    # the opened controllers, by port. see get()
+    pool = {}
+    pool_lock = threading.Lock()
+    # if set, opener(port, baudrate) gives the serial object of a port instead
+    # of pyserial, e.g. a simulated board (see bio_sim.py)
+    opener = None
+
+    def __init__(self, logger, port, baudrate=9600):
+        self.logger = logger
+        self.port = port
+        self.baudrate = baudrate
+        self.serial = None
+        # shadow state of each relay as we last sent it, so that commands
+        # which don't change anything can be skipped
+        self.states = {}
+        self.lock = threading.Lock()
+        # commands posted to the writer thread of this port, see post()
+        self.queue = Queue.Queue()
+        self.writer = None
+        # how long each write and flush took
+        self.write_time = Histogram()
+        # how many commands were written, and skipped as they changed nothing
+        self.sent = 0
+        self.redundant = 0
+        if not DEBUG:
+            self.open()
+            # stop all channels at first
+            self.stop_all()
+    @staticmethod
+    def get(logger, port, baudrate=9600):
+        """get the controller of 'port', the port is only opened the first
+        time and then reused by the later runs"""
+        RelayController.pool_lock.acquire()
+        try:
+            control = RelayController.pool.get(port)
+            if not control:
+                control = RelayController(logger, port, baudrate)
+                RelayController.pool[port] = control
+            control.logger = logger
+            return control
+        finally:
+            RelayController.pool_lock.release()
+    @staticmethod
+    def sync_all():
+        "wait until all the posted commands of all the controllers are done"
+        RelayController.pool_lock.acquire()
+        try:
+            controls = list(RelayController.pool.values())
+        finally:
+            RelayController.pool_lock.release()
+        for control in controls:
+            control.sync()
+    @staticmethod
+    def close_all():
+        "close all the opened controllers, when quitting"
+        RelayController.pool_lock.acquire()
+        try:
+            for control in RelayController.pool.values():
+                control.stop_writer()
+                control.close()
+            RelayController.pool = {}
+        finally:
+            RelayController.pool_lock.release()
+    def open(self):
+        self.log("initializing serial port (%s) with baudrate (%s)" % \
+                        (self.port, self.baudrate))
+        if RelayController.opener:
+            self.serial = RelayController.opener(self.port, self.baudrate)
+            return
+        # only needed when we really talk to the relays
+        import serial
+        self.serial = serial.Serial(port=self.port, baudrate=self.baudrate)
+    def close(self):
+        if self.serial:
+            self.log("closing serial port (%s)" % self.port)
+            try:
+                self.serial.close()
+            except (IOError, OSError):
+                pass
+            self.serial = None
+    def write(self, data):
+        """write data to the port, reconnect and retry once if it fails. If
+        the reconnect fails too, the port is opened again on the next write"""
+        if not self.serial:
+            self.open()
+        try:
+            self.serial.write(data)
+            self.serial.flush()
+        except (IOError, OSError) as e:
+            # serial.SerialException is an IOError
+            self.log("serial port error (%s), reconnecting..." % e)
+            self.close()
+            self.open()
+            self.serial.write(data)
+            self.serial.flush()
+    def log(self, msg):
+        self.logger(msg, name="relay")
+    def post(self, func, *args):
+        """call 'func(*args)' from the writer thread of this port and return
+        at once, so that the caller never waits for the serial port"""
+        if not self.writer:
+            self.writer = threading.Thread(target=self.__write_loop)
+            self.writer.daemon = True
+            self.writer.start()
+        self.queue.put((func, args))
+    def sync(self):
+        "wait until all the posted commands are done"
+        if self.writer:
+            self.queue.join()
+    def stop_writer(self):
+        if self.writer:
+            self.queue.put(None)
+            self.writer.join()
+            self.writer = None
+    def __write_loop(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                func, args = item
+                try:
+                    func(*args)
+                except Exception as e:
+                    self.log("failed to send commands: %s" % e)
+            finally:
+                self.queue.task_done()
+    def stop_all(self):
+        self.log("stopping all channels...")
+        # always sent, to be safe even if the shadow states are wrong
+        self.send_cmds([(i+1, 0) for i in range(MAX_CHANNEL_N)], force=True)
+    def frame(self, channel, value):
+        """get the packed command to set relay 'channel' to 'value'. channel
+        can be 1-8 and value can be 0-1"""
+        if channel <= 0 or channel > MAX_CHANNEL_N:
+            raise Exception("channel number (%s) should follow 0<ch<=%s" % \
+                                (channel, MAX_CHANNEL_N))
+        return RelayController.FRAMES[(channel, value)]
+    def send_cmd(self, channel, value):
+        """set the relay 'channel' with value 'value'. channel can be 1-8 and
+        value can be 0-1"""
+        self.send_cmds([(channel, value)])
+    def send_cmds(self, cmds, force=False):
+        """send a list of (channel, value) commands with a single write and
+        flush, so that they reach the relays at (almost) the same time.
+        Commands that won't change the relay are dropped unless 'force'"""
+        todo = []
+        for channel, value in cmds:
+            if value:
+                value = 1
+            else:
+                value = 0
+            if force or self.states.get(channel) != value:
+                todo.append((channel, value))
+        self.redundant += len(cmds) - len(todo)
+        if not todo:
+            return
+        data = b"".join([self.frame(channel, value) for channel, value in todo])
+        traced = TRACER.enabled and TRACER.now()
+        self.lock.acquire()
+        try:
+            if not DEBUG:
+                started = get_clock()
+                self.write(data)
+                self.write_time.add(get_clock() - started)
+            self.sent += len(todo)
+            for channel, value in todo:
+                self.states[channel] = value
+        finally:
+            self.lock.release()
+        if traced:
+            TRACER.add("send_cmds", traced, {"port": self.port,
+                                             "cmds": len(todo)})
+    def refresh(self):
+        "send the current state of every known relay again"
+        self.send_cmds(sorted(self.states.items()), force=True)
+
+def check_config(config):
+    """Check the config hash parsed from JSON, and parse the signal of each
+    channel into a Signal in place. Raises an Exception telling what is wrong
+    with the config."""
+    if "description" not in config:
+        raise Exception("need 'description' entry!")
+    if "channels" not in config:
+        raise Exception("need 'channels' entry!")
+    refresh = config.get("refresh", 0)
+    if type(refresh) not in INT_TYPES + (float,):
+        raise Exception("refresh (%s) should be digital" % refresh)
+    if "refresh" in config and refresh <= 0:
+        raise Exception("refresh (%s) should be greater than zero" % refresh)
+    if type(config.get("precise", False)) != bool:
+        raise Exception("precise (%s) should be true or false" % \
+                            config["precise"])
+    channels = config["channels"]
+    index_list = []
+    # share the identical sub-signals of all the channels
+    interned = {}
+    for chnl in channels:
+        value = channels[chnl]
+        if "channel" not in value:
+            raise Exception("channel '%s' need key 'channel' as index" % chnl)
+        if "port" in value and not isinstance(value["port"], STRING_TYPES):
+            raise Exception("port of channel '%s' should be a string" % chnl)
+        if value["channel"] not in range(1, MAX_CHANNEL_N + 1):
+            raise Exception("channel number of '%s' should be 1-%s" % \
+                                (chnl, MAX_CHANNEL_N))
+        # channels without "port" are on the default port
+        index = (value.get("port"), value["channel"])
+        if index in index_list:
+            raise Exception("channel '%s' existed more than once!" % \
+                                value["channel"])
+        index_list.append(index)
+        if "signal" not in value:
+            raise Exception("channel '%s' need key 'signal'" % chnl)
+        started = TRACER.enabled and TRACER.now()
+        try:
+            value["signal"] = Signal.parseFromHash(value["signal"], interned)
+        except Exception as e:
+            raise Exception("Failed parse signal: " + str(e))
+        if started:
+            TRACER.add("parseFromHash", started, {"channel": chnl})
+    return config
+
+def summarize_config(config):
+    """summary of a checked config, computed without expanding the signals"""
+    channels = config["channels"]
+    lines = []
+    total = 0
+    for name in WorkingThread.channel_names(channels):
+        signal = channels[name]["signal"]
+        length = signal.total_length()
+        total = max(total, length)
+        lines.append("channel '%s' [%s]: %s sec, %s events, "
+                     "%s transitions, duty cycle %.1f%%" % \
+                     (name, channels[name]["channel"], length,
+                      signal.event_count(), signal.transition_count(),
+                      signal.duty_cycle() * 100))
+    lines.insert(0, "total length: %s sec (%.2f hours)" % \
+                     (total, total / 3600.0))
+    return "\n".join(lines)
+
+def summarize_metrics(metrics):
+    "one line summary of WorkingThread.metrics()"
+    ms = lambda x: "%.1fms" % (x * 1000)
+    late = metrics["late"]
+    write = metrics["write"]
+    return "events %s, late p50 %s p99 %s max %s | sent %s (%s redundant), " \
+        "write p99 %s max %s | pending %s" % \
+        (metrics["events"], ms(late["p50"]), ms(late["p99"]), ms(late["max"]),
+         metrics["sent"], metrics["redundant"], ms(write["p99"]),
+         ms(write["max"]), metrics["pending"])
+
+class ConfigCache():
+    """
+    Checked configs of config files, so that starting the same file again
+    (e.g. with the F1-F8 keys) doesn't parse it again. The file is read
+    every time, which is cheap, and only parsed again if its content hash
+    has changed: the mtime and the size can't tell every change.
+
+    The cached configs are shared, so they should not be changed by the
+    users. WorkingThread.start() only reads them.
+    """
+    def __init__ (self):
+        # path -> (sha1, config, source)
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def load (self, path):
+        """returns (config, source) of config file 'path'. Raises an
+        Exception telling what is wrong with the file."""
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(path)
+        finally:
+            self.lock.release()
+        try:
+            f = open(path, "r")
+            source = f.read()
+            f.close()
+        except (IOError, OSError) as e:
+            raise Exception("failed to read config file '%s': %s" % (path, e))
+        digest = config_hash(source)
+        if entry and entry[0] == digest:
+            # not changed
+            config = entry[1]
+        else:
+            try:
+                config = check_config(json.loads(source))
+            except Exception as e:
+                raise Exception("failed to load config file '%s': %s" % \
+                                    (path, e))
+        self.lock.acquire()
+        try:
+            self.entries[path] = (digest, config, source)
+        finally:
+            self.lock.release()
+        return config, source
+
+    def forget (self, path=None):
+        "drop the entry of 'path', or all the entries"
+        self.lock.acquire()
+        try:
+            if path is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(path, None)
+        finally:
+            self.lock.release()
+
+class Run():
+    """
+    One config being run by the WorkingThread. It keeps everything about the
+    run: the config, the relay controllers of its ports, the lazy event queue
+    and the timing. Several runs can be active at the same time, as long as
+    they use different channels.
+    """
+    # to give each run a number, see id
+    count = 0
+
+    def __init__(self, config, controls, offset=0, name=None, clock=None):
+        Run.count += 1
+        # a number to tell the runs of this process apart
+        self.id = Run.count
+        self.config = config
+        # the RelayController of each port used by the config
+        self.controls = controls
+        self.offset = offset
+        self.name = name or config.get("description", "")
+        self.precise = bool(config.get("precise", False))
+        self.refresh = config.get("refresh", 0)
+        self.next_refresh = offset + self.refresh
+        # the id of the run in the journal, if any
+        self.run_id = None
+        self.events = None
+        # all the deadlines are absolute offsets from this start time, so the
+        # time spent on waking up, logging and serial writes won't add up
+        self.start_time = None
+        # how late (in seconds) the last/worst event fired
+        self.late_last = 0
+        self.late_max = 0
+        # the Clock of the scheduler the run is on
+        self.clock = clock or Clock()
+        self.stopping = False
+        # the offset the run is paused at, None if it's not paused
+        self.paused = None
+        # held while the events and the timing of the run are read or changed
+        # (see WorkingThread.seek()), as it's done from different threads
+        self.lock = threading.Lock()
+
+    def __str__(self):
+        return "%s (%s)" % (self.name, ", ".join(["%s:%s" % x for x in
+                                                  sorted(self.channels())]))
+
+    def channels(self):
+        "set of (port, channel) used by this run"
+        return set([(value["port"], value["channel"]) for value in
+                    self.config["channels"].values()])
+
+    def elapsed(self):
+        "how many seconds into the config the run is now"
+        if self.paused is not None:
+            return self.paused
+        return self.clock.now() - self.start_time
+
+    def status(self):
+        """a hash telling how the run is going, it's safe to call from any
+        thread"""
+        self.lock.acquire()
+        try:
+            elapsed = self.elapsed()
+            event = self.events.peek()
+        finally:
+            self.lock.release()
+        channels = self.config["channels"]
+        states = []
+        for name in WorkingThread.channel_names(channels):
+            value = channels[name]
+            states.append({"name": name, "port": value["port"],
+                           "channel": value["channel"],
+                           "state": value["signal"].state_at(elapsed)})
+        if self.stopping:
+            state = "stopping"
+        elif self.paused is not None:
+            state = "paused"
+        else:
+            state = "running"
+        return {"id": self.id, "name": self.name, "state": state,
+                "elapsed": elapsed, "channels": states,
+                "next_event": event and event["length"],
+                "late_last": self.late_last, "late_max": self.late_max}
+
+    def next_deadline(self):
+        "clock time (see Clock) when this run has something to do next"
+        self.lock.acquire()
+        try:
+            deadline = self.events.peek()["length"]
+            if self.refresh and self.next_refresh < deadline:
+                # wake up for a refresh first if it's due before the next event
+                deadline = self.next_refresh
+            return self.start_time + deadline
+        finally:
+            self.lock.release()
+
+class WorkingThread(threading.Thread):
+    """
+    The scheduler of all the runs. A single thread sleeps until the nearest
+    deadline of all the active runs, so running more configs at the same time
+    doesn't cost more threads. The thread is started with the first run and
+    quits when there is no run left.
+    """
+    def __init__(self, logger, journal=None, notify=None, event_log=None,
+                 clock=None):
+        threading.Thread.__init__(self)
+        self.logger = logger
+        # the RunJournal to record the runs into, if any
+        self.journal = journal
+        # the EventLog to write the transitions into, if any
+        self.event_log = event_log
+        # all the waiting and timing is done with this Clock
+        self.clock = clock or Clock()
+        # how late the events were handled, and how many, see metrics()
+        self.late = Histogram()
+        self.events = 0
+        # called (from any thread) when the list of runs changes
+        self.notify = notify
+        # set to use schedules compiled into arrays (see bio_compile.py)
+        # instead of expanding the signals lazily
+        self.compiled = False
+        # set to wake the thread up when the runs are changed
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.cleanup()
+
+    def cleanup (self):
+        self.thread = None
+        self.runs = []
+        self.event.clear()
+
+    def log(self, msg):
+        self.logger(msg, name="thread")
+
+    def changed(self):
+        if self.notify:
+            self.notify()
+
+    def metrics(self):
+        """a snapshot of the counters of the scheduler and of all the relay
+        controllers, it's safe to call from any thread:
+        - events: events handled, "late" is the histogram of their lateness
+        - sent/redundant: relay commands written, and the ones skipped since
+          they won't change the relay. "write" is the histogram of how long
+          each write (with flush) took
+        - pending: commands posted to the ports but not written yet"""
+        write = Histogram()
+        sent = redundant = pending = 0
+        RelayController.pool_lock.acquire()
+        try:
+            controls = list(RelayController.pool.values())
+        finally:
+            RelayController.pool_lock.release()
+        for control in controls:
+            write.merge(control.write_time)
+            sent += control.sent
+            redundant += control.redundant
+            pending += control.queue.qsize()
+        return {"runs": len(self.active_runs()), "events": self.events,
+                "late": self.late.snapshot(), "sent": sent,
+                "redundant": redundant, "write": write.snapshot(),
+                "pending": pending}
+
+    def active_runs(self):
+        "the runs that are still active"
+        self.lock.acquire()
+        try:
+            return [run for run in self.runs if not run.stopping]
+        finally:
+            self.lock.release()
+
+    @staticmethod
+    def channel_names(channels):
+        """names of the channels sorted by (port, channel), which is also the
+        order of events happening at the same time"""
+        return sorted(channels, key=lambda x: (channels[x].get("port", ""),
+                                               channels[x]["channel"], x))
+
+    def start(self, config, port, offset=0, source=None, name=None):
+        """start running 'config' on serial 'port', which is the default for
+        channels without their own "port". If 'offset' is set, the run is
+        resumed at 'offset' seconds into the config. 'source' is the config
+        text, which is recorded into the journal. Returns the new Run, or None
+        if it can't be started."""
+        # the signals are never changed once parsed, so only the hashes around
+        # them are copied, and configs can be shared (see ConfigCache)
+        channels = {}
+        # the channel using each relay, now that the default port is known
+        relays = {}
+        for chnl in sorted(config["channels"]):
+            channels[chnl] = dict(config["channels"][chnl])
+            channels[chnl].setdefault("port", port)
+            relay = (channels[chnl]["port"], channels[chnl]["channel"])
+            if relay in relays:
+                self.log("can't start, channels '%s' and '%s' both use "
+                         "relay %s:%s." % ((relays[relay], chnl) + relay))
+                return None
+            relays[relay] = chnl
+        config = dict(config)
+        config["channels"] = channels
+        # try to open the serial ports first (which is called the RelayControler)
+        controls = {}
+        try:
+            for value in config["channels"].values():
+                if value["port"] not in controls:
+                    controls[value["port"]] = \
+                        RelayController.get(self.logger, value["port"])
+        except:
+            self.log("Thread didn't start due to init relay controller fail.")
+            return None
+
+        run = Run(config, controls, offset, name, self.clock)
+        self.lock.acquire()
+        try:
+            used = set()
+            for other in self.runs:
+                if not other.stopping:
+                    used |= other.channels()
+            conflicts = run.channels() & used
+            if conflicts:
+                self.log("can't start '%s', channel(s) %s already in use." % \
+                             (run.name, ", ".join(["%s:%s" % x for x in
+                                                   sorted(conflicts)])))
+                return None
+            self.log("going to START run '%s'..." % run.name)
+            if self.journal and source is not None:
+                run.run_id = self.journal.begin(source, port, offset,
+                                                run.name)
+            self.seek(run, offset)
+            if run.run_id:
+                self.journal.watch(run.run_id, run.elapsed)
+            self.runs.append(run)
+            self.schedule(run)
+        finally:
+            self.lock.release()
+        self.changed()
+        return run
+
+    def stop(self, run=None):
+        "stop 'run', or all the runs if it's None"
+        runs = self.active_runs()
+        if run:
+            runs = [x for x in runs if x is run]
+        if not runs:
+            self.log("there is no running test at all.")
+            return
+        for run in runs:
+            self.log("going to STOP run '%s'..." % run.name)
+            run.stopping = True
+        self.wakeup()
+
+    def wait_done(self, timeout=None):
+        """wait until the scheduler thread quits, which is when all the runs
+        are finished and their channels switched off (see finish())"""
+        self.lock.acquire()
+        try:
+            thread = self.thread
+        finally:
+            self.lock.release()
+        if thread:
+            thread.join(timeout)
+
+    def seek(self, run, offset):
+        "make 'run' go on from 'offset' seconds into its config"
+        events = self.generate_event_queue(run.config, offset)
+        run.lock.acquire()
+        try:
+            run.events = events
+            run.offset = offset
+            if offset > 0:
+                self.log("resuming at %s sec..." % offset)
+            # the new events assume the relays are as they should be at the
+            # offset: all off for a new run, but a run that is going (or is
+            # resumed) may have set them otherwise
+            if offset > 0 or run.start_time is not None:
+                self.restore_states(run)
+            run.next_refresh = offset + run.refresh
+            run.start_time = self.clock.now() - offset
+        finally:
+            run.lock.release()
+
+    def pause(self, run):
+        """pause 'run', its relays keep their states until it's resumed"""
+        if run.stopping or run.paused is not None:
+            return
+        run.lock.acquire()
+        try:
+            run.paused = run.elapsed()
+        finally:
+            run.lock.release()
+        self.log("run '%s' paused at %.3f sec." % (run.name, run.paused))
+        self.wakeup()
+
+    def resume(self, run, offset=None):
+        """resume a paused 'run' where it was paused, or at 'offset' seconds
+        into its config. A running run can be moved to 'offset' too."""
+        if run.stopping:
+            return
+        if offset is None:
+            if run.paused is None:
+                return
+            offset = run.paused
+        self.lock.acquire()
+        try:
+            self.seek(run, offset)
+            run.paused = None
+        finally:
+            self.lock.release()
+        self.log("run '%s' resumed at %.3f sec." % (run.name, offset))
+        self.wakeup()
+        self.changed()
+
+    def schedule(self, run):
+        "get the new 'run' going, called with the lock held"
+        if not self.thread:
+            self.thread = threading.Thread(target=self.run)
+            self.thread.start()
+        else:
+            # let the thread know about the new run
+            self.event.set()
+
+    def wakeup(self):
+        "let the scheduler know that some runs are stopping"
+        self.event.set()
+
+    def generate_event_queue(self, config, offset=0):
+        """generate event queue from the config file hash. Events are merged
+        lazily from each channel's signal, see EventQueue, or compiled into
+        arrays if 'compiled' is set, see bio_compile.py. Only the events
+        after 'offset' seconds are generated."""
+        # config should have been checked before, just use it.
+        started = TRACER.enabled and TRACER.now()
+        events = None
+        if self.compiled:
+            # only needed for the compiled schedules, which need numpy
+            from bio_compile import compile_config
+            try:
+                events = compile_config(config, offset)
+            except Exception as e:
+                self.log("failed to compile the schedule (%s), will expand "
+                         "it lazily." % e)
+        if events is None:
+            events = self.__event_queue(config, offset)
+        if started:
+            TRACER.add("generate_event_queue", started, {"offset": offset})
+        return events
+
+    def __event_queue(self, config, offset):
+        channels = config["channels"]
+        events = EventQueue()
+        # add the channels in index order, so that events of different
+        # channels at the same time are always handled in the same order
+        for name in WorkingThread.channel_names(channels):
+            port = channels[name]["port"]
+            channel = channels[name]["channel"]
+            signal = channels[name]["signal"]
+            events.add_stream(self.__channel_events(signal, name, port,
+                                                    channel, offset))
+        return events
+
+    def __channel_events(self, signal, name, port, channel, offset):
+        # the relays are all off at start, or restored when resuming
+        prev = bool(signal.state_at(offset))
+        for event in signal.iter_events(after=offset):
+            # drop the events that don't change the state at all
+            if bool(event["state"]) == prev:
+                continue
+            prev = bool(event["state"])
+            event["port"] = port
+            event["channel"] = channel
+            event["name"] = name
+            yield event
+
+    def restore_states(self, run):
+        """set every channel to the state it should have at the offset of
+        'run', used when resuming a run"""
+        channels = run.config["channels"]
+        cmds = {}
+        for name in WorkingThread.channel_names(channels):
+            port = channels[name]["port"]
+            channel = channels[name]["channel"]
+            state = channels[name]["signal"].state_at(run.offset)
+            self.log("restore channel '%s' [%s:%s] ==> %s" % \
+                         (name, port, channel, state))
+            cmds.setdefault(port, []).append((channel, state))
+        for port in cmds:
+            run.controls[port].post(run.controls[port].send_cmds, cmds[port])
+
+    def wait_until(self, deadline, precise=False):
+        """wait until clock 'deadline' (see Clock), returns True if we got
+        woken up by the event during the wait. In precise mode, the last
+        SPIN_TIME seconds are spent busy-waiting rather than sleeping. If
+        'deadline' is None, wait until woken up."""
+        if deadline is None or not precise or not self.clock.real:
+            return self.clock.wait_until(self.event, deadline)
+        if self.clock.wait_until(self.event, deadline - SPIN_TIME):
+            return True
+        while self.clock.now() < deadline:
+            if self.event.is_set():
+                return True
+            # let the writer threads of the ports run while spinning
+            time.sleep(0)
+        return False
+
+    def handle_events(self, run, events):
+        """send all the events of 'run' that are due at the same time in one
+        go for each port, then do the bookkeeping of each"""
+        started = TRACER.enabled and TRACER.now()
+        cmds = {}
+        for event in events:
+            cmds.setdefault(event["port"], []).append((event["channel"],
+                                                       event["state"]))
+        for port in cmds:
+            run.controls[port].post(run.controls[port].send_cmds, cmds[port])
+        for event in events:
+            self.handle_event(run, event)
+        if started:
+            TRACER.add("handle_events", started, {"run": run.name,
+                                                  "events": len(events)})
+
+    def handle_event(self, run, event):
+        """log and record an event that has been sent. event should be:
+        {"name", "length", "port", "channel", "state", "late"}"""
+        name = event["name"]
+        port = event["port"]
+        channel = event["channel"]
+        state = event["state"]
+        self.log("set channel '%s' [%s:%s] ==> %s (late %.3f sec)" % \
+                     (name, port, channel, state, event["late"]))
+        if run.run_id:
+            self.journal.event(run.run_id, event)
+        if self.event_log:
+            self.event_log.append(run, event)
+
+    def handle_due(self, run):
+        "do whatever 'run' should have done by now"
+        # the events and the timing of the run can be changed by seek() from
+        # another thread meanwhile
+        run.lock.acquire()
+        try:
+            due = self.__take_due(run)
+        finally:
+            run.lock.release()
+        if due:
+            self.handle_events(run, due)
+
+    def __take_due(self, run):
+        """pop the events of 'run' that are due and return them, or refresh
+        its channels if that is due first. Called with the lock of the run"""
+        if run.paused is not None:
+            return []
+        run_time = self.clock.now() - run.start_time
+        if run.refresh and run.next_refresh <= run_time and \
+                run.next_refresh < run.events.peek()["length"]:
+            self.log("refreshing channels of '%s'..." % run.name)
+            for control in run.controls.values():
+                control.post(control.refresh)
+            run.next_refresh += run.refresh
+            return []
+        # handle events that should happen now (and the ones we missed)
+        due = []
+        while not run.events.empty() and \
+                run.events.peek()["length"] <= run_time:
+            due.append(run.events.pop())
+        if not due:
+            return due
+        now = self.clock.now() - run.start_time
+        for event in due:
+            event["late"] = now - event["length"]
+            run.late_last = event["late"]
+            run.late_max = max(run.late_max, event["late"])
+            self.late.add(event["late"])
+        self.events += len(due)
+        return due
+
+    def finish(self, run):
+        "remove a run that is done or stopped, and switch its channels off"
+        if run.run_id:
+            if run.events.empty():
+                self.journal.end(run.run_id, "done")
+            else:
+                self.journal.end(run.run_id, "stopped")
+            run.run_id = None
+        cmds = {}
+        for port, channel in run.channels():
+            cmds.setdefault(port, []).append((channel, 0))
+        for port in cmds:
+            # always sent, to be safe even if the shadow states are wrong
+            run.controls[port].post(run.controls[port].send_cmds,
+                                    sorted(cmds[port]), True)
+        self.lock.acquire()
+        try:
+            self.runs.remove(run)
+        finally:
+            self.lock.release()
+        self.log("run '%s' stopped." % run.name)
+        self.changed()
+
+    def run(self):
+        "the scheduler loop of all the runs"
+        self.log("thread started.")
+        while True:
+            self.event.clear()
+            self.lock.acquire()
+            try:
+                runs = list(self.runs)
+                if not runs:
+                    self.thread = None
+                    break
+            finally:
+                self.lock.release()
+            # the run with the nearest deadline
+            first = None
+            deadline = None
+            active = []
+            paused = 0
+            for run in runs:
+                if run.paused is not None and not run.stopping:
+                    paused += 1
+                    continue
+                if run.stopping or run.events.empty():
+                    self.finish(run)
+                    continue
+                active.append(run)
+                if first is None or run.next_deadline() < deadline:
+                    first = run
+                    deadline = run.next_deadline()
+            if first is None:
+                if paused:
+                    # all the runs left are paused
+                    self.log("all runs paused, waiting...")
+                    self.wait_until(None)
+                continue
+            sleep_time = deadline - self.clock.now()
+            if sleep_time > 0:
+                self.log("sleeping %.3f sec..." % sleep_time)
+                started = TRACER.enabled and TRACER.now()
+                # using events rather than raw sleep
+                woken = self.wait_until(deadline, first.precise)
+                if started:
+                    TRACER.add("wait", started)
+                if woken:
+                    # runs are added or stopped
+                    continue
+            for run in active:
+                self.handle_due(run)
+        self.log("Thread stopped.")
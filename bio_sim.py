@@ -0,0 +1,183 @@
+#!/usr/bin/python
+"""
+Simulated relay boards and a virtual clock, to check a config without the
+hardware and without waiting for it: a 3-day protocol can be run in seconds,
+and the result is the trace of every relay transition the boards saw.
+
+    sim = Simulator(VirtualClock())
+    sim.install()
+    engine = WorkingThread(logger, clock=sim.clock)
+    ...
+    for time, port, channel, state in sim.trace():
+        ...
+
+The boards get the same serial frames as the real ones (see FrameDecoder),
+through the same RelayController code. PtyBoard is a board on a pseudo
+terminal, for programs which open a real serial port, like the GUI.
+"""
+
+import os
+import threading
+
+import bio_core
+from bio_core import Clock, RelayController, MAX_CHANNEL_N, get_clock
+
+class FrameDecoder():
+    """
+    Decodes the frames written to a relay board: 0xFF, channel, value,
+    channel + value, 0xEE. Bytes which are not a good frame are skipped, and
+    counted in 'errors'.
+    """
+    def __init__ (self):
+        self.buffer = bytearray()
+        self.errors = 0
+
+    def feed (self, data):
+        "returns the list of (channel, value) decoded from 'data' so far"
+        self.buffer.extend(bytearray(data))
+        buf = self.buffer
+        cmds = []
+        i = 0
+        while len(buf) - i >= 5:
+            if buf[i] != 0xFF or buf[i + 4] != 0xEE or \
+                    buf[i + 3] != (buf[i + 1] + buf[i + 2]) & 0xFF or \
+                    not 1 <= buf[i + 1] <= MAX_CHANNEL_N or buf[i + 2] > 1:
+                # not a frame, try the next byte
+                self.errors += 1
+                i += 1
+                continue
+            cmds.append((buf[i + 1], buf[i + 2]))
+            i += 5
+        del buf[:i]
+        return cmds
+
+class SimulatedBoard():
+    """
+    A relay board which only records what it's told to do. It has the
+    write()/flush()/close() of a serial port, so a RelayController can use it
+    as one (see RelayController.opener).
+
+    - states: state of each relay, all off at start
+    - frames: how many frames were received
+    - trace: list of (time, port, channel, state) of each relay transition,
+      with the time of 'clock'
+    """
+    def __init__ (self, port, clock=None, logger=None):
+        self.port = port
+        self.clock = clock or Clock()
+        self.logger = logger
+        self.decoder = FrameDecoder()
+        self.states = dict([(i + 1, 0) for i in range(MAX_CHANNEL_N)])
+        self.frames = 0
+        self.trace = []
+
+    def write (self, data):
+        now = self.clock.now()
+        for channel, value in self.decoder.feed(data):
+            self.frames += 1
+            if self.states[channel] == value:
+                continue
+            self.states[channel] = value
+            self.trace.append((now, self.port, channel, value))
+            if self.logger:
+                self.logger("relay [%s:%s] ==> %s at %.3f sec" % \
+                                (self.port, channel, value, now), name="board")
+        return len(data)
+
+    def flush (self):
+        pass
+
+    def close (self):
+        pass
+
+class VirtualClock(Clock):
+    """
+    A clock for the scheduler that starts at zero. If 'speed' is set, it goes
+    'speed' times faster than the real one. Otherwise it's as fast as the CPU
+    allows: waiting jumps to the deadline at once, once the commands posted
+    so far have reached the boards, so the trace has the exact planned times.
+    """
+    real = False
+
+    def __init__ (self, speed=None):
+        self.speed = speed
+        self.time = 0
+        self.base = get_clock()
+
+    def now (self):
+        if self.speed:
+            return (get_clock() - self.base) * self.speed
+        return self.time
+
+    def wait_until (self, event, deadline):
+        if deadline is None:
+            event.wait()
+            return True
+        if self.speed:
+            return event.wait((deadline - self.now()) / self.speed) == True
+        RelayController.sync_all()
+        if event.is_set():
+            return True
+        self.time = max(self.time, deadline)
+        return False
+
+class Simulator():
+    """
+    A SimulatedBoard for every port that is opened, after install(). The
+    boards use 'clock', which should be the clock of the scheduler too.
+    """
+    def __init__ (self, clock=None, logger=None):
+        self.clock = clock or VirtualClock()
+        self.logger = logger
+        # the board of each port
+        self.boards = {}
+
+    def open (self, port, baudrate):
+        if port not in self.boards:
+            self.boards[port] = SimulatedBoard(port, self.clock, self.logger)
+        return self.boards[port]
+
+    def install (self):
+        "let all the RelayControllers opened from now on use the boards"
+        bio_core.DEBUG = 0
+        RelayController.opener = self.open
+
+    def trace (self):
+        "the transitions of all the boards, in time order"
+        trace = []
+        for port in sorted(self.boards):
+            trace.extend(self.boards[port].trace)
+        # sorted() is stable, so the order of each port is kept
+        return sorted(trace, key=lambda x: x[0])
+
+class PtyBoard():
+    """
+    A SimulatedBoard behind a pseudo terminal, whose path is 'name'. Point
+    the serial port of the GUI (or anything else) to it to see the relay
+    transitions without the hardware.
+    """
+    def __init__ (self, logger=None, clock=None):
+        import tty
+        self.master, self.slave = os.openpty()
+        # no line discipline, the frames are binary
+        tty.setraw(self.slave)
+        self.name = os.ttyname(self.slave)
+        self.board = SimulatedBoard(self.name, clock, logger)
+        self.thread = threading.Thread(target=self.__read_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __read_loop (self):
+        while True:
+            try:
+                data = os.read(self.master, 1024)
+            except OSError:
+                # closed
+                return
+            if not data:
+                return
+            self.board.write(data)
+
+    def close (self):
+        os.close(self.slave)
+        os.close(self.master)
@@ -7,19 +7,17 @@ import wx
 import wx.lib.rcsizer as rcs
 import json
 import datetime
-import threading
-import time
-import copy
-import serial
-import struct
+import collections
+
+from bio_core import *
 
-OS_TYPE=sys.platform            # can be 'darwin'
 PROG_NAME = "Bio Relay Controller"
 PROG_VERSION = "0.3"
 LOG_LINES = 50
+# how often (in ms) the new log lines are shown in the log area
+LOG_FLUSH_TIME = 100
 LEFT_PANEL_WIDTH = 500
 BUTTON_SIZE = (150, 20)
-MAX_CHANNEL_N = 8
 QUICK_LOAD_CONFIG_FILE="quick_load.bio_config"
 ABOUT_INFO = """This is a tiny program written for doudou for his bio
 experiment. Please feel free to use it as a tool or for source code study. You
@@ -36,6 +34,7 @@ as:
   "state": 1
 }
 This is the basic signal, mean "sleep for 20 seconds, and then set XXX to 1"
+"length" can also be fractional, like 0.05 for a 50ms pulse.
 
 2. Combined Signal
 {
@@ -55,327 +54,82 @@ This is a combined signal, which is composed by 3 atomic signal, and will loop
 for three times.
 
 Combined signals can be nested.
-"""
-# set this if we don't want to really control the relay, but only test the logic
-DEBUG = 1
-
-# set default serial port
-DEFAULT_PORT_LIST = {"darwin": "/dev/tty.usbserial", "win32": "COM1"}
-if OS_TYPE not in DEFAULT_PORT_LIST:
-    print "OS type not known: '%s'" % OS_TYPE
-    exit (1)
-DEFAULT_PORT = DEFAULT_PORT_LIST[OS_TYPE]
-
-class Signal():
-    """
-    A signal is a so-called signal with a time axis and a value. One signal can
-    be inited in two ways:
-
-    1. atomic signal: "length" and "state" are required. It defines a static
-       signal with state and which holds a specific length.
-    2. combined signal: "sub_signals" is required. "cycle" is optional to
-       describe that how many times the combined signal will be replayed. The
-       default value of "cycle" is set to 1, which is only once.
-
-    attributes for a signal:
-    - config: the hash representation
-    """
-    def __init__ (self, length=-1, state=-1, sub_signals=[], cycle=1):
-        if length != -1 and state != -1:
-            # this is an atomic signal
-            self.__type = "atomic"
-            if type(length) != type(1):
-                self.err("length (%s) should be digital" % length)
-            if length <= 0:
-                self.err("length (%s) should be greater than zero" % length)
-            if type(state) != type(1):
-                self.err("state (%s) should be digital" % state)
-            self.length = length
-            self.state = state
-        elif sub_signals and cycle:
-            # this is a combined signal
-            self.__type = "combined"
-            if type(cycle) != type(1):
-                self.err("cycle (%s) should be digital" % cycle)
-            # each of the sub-signal should be another signal instance
-            for sig in sub_signals:
-                if not isinstance(sig, Signal):
-                    self.err("item '%s' is not Signal" % sig)
-            self.sub_signals = copy.deepcopy(sub_signals)
-            self.cycle = cycle
-        else:
-            self.err("Failed to init Signal instance, param not right")
-
-    def __dumpAtomic (self, start):
-        return [{"length": self.length + start, "state": self.state}]
-
-    def __dumpCombined (self, start):
-        result = []
-        for i in range(self.cycle):
-            for signal in self.sub_signals:
-                result += signal.dump(start)
-                # update the start for next signal
-                start = result[-1]["length"]
-        return result
-
-    def __str__ (self):
-        if self.__type == "atomic":
-            return "<Signal(atomic): length=%s,state=%s>" % \
-                (self.length, self.state)
-        elif self.__type == "combined":
-            result = "<Signal(combined,cycle=%s):\n" % self.cycle
-            for signal in self.sub_signals:
-                sub_result = str(signal)
-                for line in sub_result.split("\n"):
-                    result += "  " + line + "\n"
-            return result.strip() + ">"
-
-    def err (self, s):
-        self.err(s)
-
-    def dump (self, start=0):
-        """Dump this signal into an array that describes the signal. param
-        'start' is the starting timestamp."""
-        if self.__type == "atomic":
-            return self.__dumpAtomic(start)
-        elif self.__type == "combined":
-            return self.__dumpCombined(start)
-        else:
-            self.err("unknown signal type: " + str(__type))
-
-    @staticmethod
-    def parseFromHash (config):
-        """This is a static method for Signal class to generate a Signal
-        instance using an hash like this:
-        {
-            "sub_signals": [
-                {
-                    "length": 20,
-                    "state": 1
-                },
-                {
-                    "length": 10,
-                    "state": 0
-                },
-                {
-                    "length": 15,
-                    "state": 1
-                }
-            ],
-            "cycle": 3
-        }
-        or a simple atomic signal:
-        {
-            "length": 50,
-            "state": 1
-        }
-        or a really complex looped-define signal:
-        {
-            "sub_signals": [
-                {
-                    "sub_signals": [
-                        {
-                            "length": 30,
-                            "state": 0
-                        },
-                        {
-                            "length": 20,
-                            "state": 1
-                        },
-                    ],
-                    "cycle": 2
-                },
-                {
-                    "length": 10,
-                    "state": 0
-                }
-            ],
-            "cycle": 3
-        }
-        """
-        if type(config) != type({}):
-            raise Exception("type of 'config' not right (should be hash)")
-        if "length" in config and "state" in config:
-            # this is a normal atomic signal
-            return Signal(length=config["length"], state=config["state"])
-        elif "sub_signals" in config:
-            # this should be a combined signal
-            if "cycle" in config:
-                cycle = config["cycle"]
-            else:
-                # this is the default
-                cycle = 1
-            sig_list = []
-            sub_signals = config["sub_signals"]
-            if type(sub_signals) != type([]):
-                raise Exception("sub_signals (%s) should be a array like: [...]"\
-                             % sub_signals)
-            for signal in sub_signals:
-                sig = Signal.parseFromHash(signal)
-                sig_list.append(sig)
-            return Signal(sub_signals=sig_list, cycle=cycle)
-        else:
-            raise Exception("we need 'sub_signals/cycle' or 'length/state'")
-
-class RelayController():
-    def __init__(self, logger, port, baudrate=9600):
-        self.logger = logger
-        if not DEBUG:
-            self.log("initializing serial port (%s) with baudrate (%s)" % \
-                            (port, baudrate))
-            self.serial = serial.Serial(port=port, baudrate=baudrate)
-            # stop all channels at first
-            self.stop_all()
-    def log(self, msg):
-        self.logger(msg, name="relay")
-    def stop_all(self):
-        self.log("stopping all channels...")
-        for i in range(MAX_CHANNEL_N):
-            self.send_cmd(i+1, 0)
-    def send_cmd(self, channel, value):
-        """set the relay 'channel' with value 'value'. channel can be 1-8 and
-        value can be 0-1"""
-        if DEBUG:
-            return
-        if channel <= 0 or channel > MAX_CHANNEL_N:
-            raise Exception("channel number (%s) should follow 0<ch<=%s" % \
-                                (channel, MAX_CHANNEL_N))
-        if value:
-            value = 1
-        else:
-            value = 0
-        data = struct.pack("5B", 0xFF, channel, value, channel + value, 0xEE)
-        self.serial.write(data)
-        self.serial.flush()
-
-class WorkingThread(threading.Thread):
-    STATUS_IDLE = 0
-    STATUS_WORKING = 1
-    def __init__(self, logger):
-        threading.Thread.__init__(self)
-        self.logger = logger
-        self.event = threading.Event()
-        self.cleanup()
-
-    def cleanup (self):
-        self.thread = None
-        self.config = None
-        self.control = None
-        self.event.clear()
-        self.state = WorkingThread.STATUS_IDLE
-
-    def log(self, msg):
-        self.logger(msg, name="thread")
 
-    def start(self, config, port):
-        # try to open the serial port first (which is called the RelayControler)
-        try:
-            self.control = RelayController(self.logger, port=port)
-        except:
-            self.control = None
-            self.log("Thread didn't start due to init relay controller fail.")
-            return
+Some relay boards need to be told their state again from time to time. Add
+'"refresh": 60' to the top level of the config to re-send the state of every
+channel each 60 seconds. Otherwise, a command is only sent when the state of a
+channel really changes.
 
-        self.log("going to START working thread...")
-        self.state = WorkingThread.STATUS_WORKING
-        self.config = copy.deepcopy(config)
-        self.thread = threading.Thread(target=self.run)
-        self.thread.start()
+Each channel drives relay "channel" (1-8) of the board on the serial port set
+in the main window. To use more boards, give the channel a "port" too, like
+'"port": "/dev/ttyUSB1"'. Every port is written by its own thread, so a slow
+board won't delay the others.
 
-    def stop(self):
-        if not self.thread:
-            self.log("there is no working thread at all.")
-            return
-        self.log("going to STOP working thread... will stop at next event.")
-        self.state = WorkingThread.STATUS_IDLE
-        # notify thread that we are quitting
-        self.event.set()
-        # self.thread.join()
-        # self.log("child thread joined.")
-        # self.cleanup()
-
-    def generate_event_queue(self, config):
-        """generate event queue from the config file hash"""
-        # config should have been checked before, just use it.
-        channels = config["channels"]
-        events = []
-        for name in channels:
-            channel = channels[name]["channel"]
-            # total = 0
-            # for duration in channels[name]["timing"]:
-            #     duration["length"] += total
-            #     total = duration["length"]
-            #     duration["channel"] = channel
-            #     duration["name"] = name
-            #     events.append(duration)
-            signal = channels[name]["signal"]
-            chnl_events = signal.dump()
-            for event in chnl_events:
-                event["channel"] = channel
-                event["name"] = name
-            events += chnl_events
-        events.sort(key=lambda x: x["length"])
-        return events
-
-    def handle_event(self, event):
-        """event should be: {"name", "length", "channel", "state"}"""
-        name = event["name"]
-        channel = event["channel"]
-        state = event["state"]
-        self.log("set channel '%s' [%s] ==> %s" % (name, channel, state))
-        self.control.send_cmd(channel, state)
-
-    def run(self):
-        "config should be the config hash of app"
-        config = self.config
-        # generate the event queue to handle
-        events = self.generate_event_queue(config)
-        self.log("thread started with event queue: ")
-        self.log(json.dumps(events, indent=2))
-        # this records the running time
-        run_time = 0
-        while self.state == WorkingThread.STATUS_WORKING:
-            if len(events) == 0:
-                # all the events handled
-                break
-            sleep_time = events[0]["length"] - run_time
-            self.log("sleeping %s sec..." % sleep_time)
-            # using events rather than raw sleep
-            ret = self.event.wait(sleep_time)
-            if ret == True:
-                self.log("got stop event... quitting")
-                self.event.clear()
-                break
-            run_time += sleep_time
-            # handle events that should happen now
-            while len(events) > 0 and events[0]["length"] == run_time:
-                event = events.pop(0)
-                self.handle_event(event)
-        self.state = WorkingThread.STATUS_IDLE
-        self.control.stop_all()
-        self.cleanup()
-        self.log("Thread stopped.")
+For pulses shorter than about 100ms, add '"precise": true' to the top level of
+the config. The working thread will then sleep coarsely and spin for the last
+few milliseconds before each event, which is more accurate but uses more CPU.
+"""
 
 class MainWindow (wx.Frame):
     def __init__ (self, parent, title):
         wx.Frame.__init__(self, parent=parent, title=title,
                           style=wx.SYSTEM_MENU | wx.CAPTION | wx.CLOSE_BOX | wx.WANTS_CHARS)
         self.config = None
+        # lines shown in the log area
         self.logLines = 0
-        self.logBuffer = []
+        # lines waiting to be shown, appended from any thread. If the GUI
+        # falls behind, the oldest ones are dropped
+        self.logBuffer = collections.deque(maxlen=LOG_LINES)
+        self.runs = []
+        # checked configs of the F1-F8 quick load files
+        self.configCache = ConfigCache()
         self.InitFrame()
-        self.workThread = WorkingThread(self.Log)
+        self.journal = RunJournal(JOURNAL_FILE, self.Log)
+        self.eventLog = EventLog(EVENT_LOG_FILE, logger=self.Log)
+        self.workThread = WorkingThread(self.Log, self.journal,
+                                        lambda: wx.CallAfter(self.UpdateRunList),
+                                        self.eventLog)
+        self.CheckUnfinishedRun()
 
     def Log(self, str, name="main"):
+        """log a line. This can be called from any thread and never waits for
+        the GUI, the line is shown by the next FlushLog()"""
+        started = TRACER.enabled and TRACER.now()
         str = "%s: [%s] %s" % (datetime.datetime.now().ctime(), name, str)
         self.logBuffer.append(str)
-        if len(self.logBuffer) > LOG_LINES:
-            self.logBuffer.pop(0)
-        self.FlushLog()
-
-    def FlushLog(self):
-        self.logArea.SetValue("\n".join(self.logBuffer))
+        if started:
+            TRACER.add("Log", started)
+
+    def FlushLog(self, e=None):
+        "append the pending lines to the log area, called by the log timer"
+        self.UpdateStatus()
+        started = TRACER.enabled and TRACER.now()
+        lines = []
+        while True:
+            try:
+                lines.append(self.logBuffer.popleft())
+            except IndexError:
+                break
+        if not lines:
+            return
+        if self.logLines:
+            lines.insert(0, "")
+        self.logArea.AppendText("\n".join(lines))
+        self.logLines += len(lines) - (self.logLines and 1 or 0)
+        if self.logLines > LOG_LINES:
+            # only keep the last LOG_LINES lines
+            extra = self.logLines - LOG_LINES
+            self.logArea.Remove(0, self.logArea.XYToPosition(0, extra))
+            self.logLines = LOG_LINES
         self.logArea.SetInsertionPointEnd()
+        if started:
+            TRACER.add("FlushLog", started, {"lines": len(lines)})
+
+    def UpdateStatus(self):
+        "show the metrics of the working thread in the status bar"
+        text = summarize_metrics(self.workThread.metrics())
+        if text != self.statusBar.GetStatusText():
+            self.statusBar.SetStatusText(text)
 
     def AddFocusObject(self, obj):
         if not hasattr(self, "focusList"):
@@ -406,6 +160,8 @@ class MainWindow (wx.Frame):
         # the About menu
         self.aboutMenu = aboutMenu = wx.Menu()
         aboutButton = aboutMenu.Append(wx.ID_ANY, "&About", "About the program")
+        self.traceButton = aboutMenu.AppendCheckItem(wx.ID_ANY, "&Trace Runs",
+                                                     "Save timed spans of the runs into '%s'" % TRACE_FILE)
 
         # the menu bar creation
         self.menuBar = menuBar = wx.MenuBar()
@@ -448,6 +204,8 @@ class MainWindow (wx.Frame):
 
         self.portLabel = wx.StaticText(self, -1, "Serial Port: ", style=wx.ALIGN_LEFT)
         self.portConfig = wx.TextCtrl(self, value=DEFAULT_PORT)
+        self.offsetLabel = wx.StaticText(self, -1, "Start at (sec): ", style=wx.ALIGN_LEFT)
+        self.offsetConfig = wx.TextCtrl(self, value="0")
         self.buttonLoadConfig = btnLoad = wx.Button(self, -1, "Load Config", size=BUTTON_SIZE)
         self.buttonCheckConfig = btnCheck = wx.Button(self, -1, "Check Config", size=BUTTON_SIZE)
         self.buttonSaveConfig = btnSave = wx.Button(self, -1, "Save Config", size=BUTTON_SIZE)
@@ -456,11 +214,17 @@ class MainWindow (wx.Frame):
         self.buttonQuit = btnQuit = wx.Button(self, -1, "Quit Program", size=BUTTON_SIZE)
         self.buttonSaveQuick = btnSaveQuick = wx.Button(self, -1, "Save F1-F8 configs", size=BUTTON_SIZE)
         btnList = [btnLoad, btnCheck, btnSave, btnStart, btnStop, btnQuit]
+        self.runLabel = wx.StaticText(self, -1, "Running tests: ", style=wx.ALIGN_LEFT)
+        self.runList = wx.ListBox(self, size=(150, 80))
 
         sizerRight.Add(self.portLabel, 0, wx.EXPAND)
         sizerRight.Add(self.portConfig, 0, wx.EXPAND)
+        sizerRight.Add(self.offsetLabel, 0, wx.EXPAND)
+        sizerRight.Add(self.offsetConfig, 0, wx.EXPAND)
         for btn in btnList:
             sizerRight.Add(btn, 0, wx.EXPAND)
+        sizerRight.Add(self.runLabel, 0, wx.EXPAND)
+        sizerRight.Add(self.runList, 0, wx.EXPAND)
 
         # adding F1-F8 shortcut keys
         self.labelFx = []
@@ -477,7 +241,7 @@ class MainWindow (wx.Frame):
             self.configNameFx.append(configBox)
             self.AddFocusObject(configBox)
         # add one line help:
-        label = wx.StaticText(self, -1, "Please use F1-F8 to \nquick load/run config files, \nor use F10 to stop any run.")
+        label = wx.StaticText(self, -1, "Please use F1-F8 to \nquick load/run config files, \nor use F10 to stop the selected \nrun (or all runs).")
         sizerRight.Add(label, 0)
         sizerRight.Add(btnSaveQuick)
 
@@ -504,6 +268,8 @@ class MainWindow (wx.Frame):
         self.Bind(wx.EVT_MENU, self.OnOpen, loadButton)
         self.Bind(wx.EVT_MENU, self.OnQuit, quitButton)
         self.Bind(wx.EVT_MENU, self.OnAbout, aboutButton)
+        self.Bind(wx.EVT_MENU, self.OnTrace, self.traceButton)
+        self.Bind(wx.EVT_CLOSE, self.OnClose)
         btnLoad.Bind(wx.EVT_BUTTON, self.OnOpen)
         btnCheck.Bind(wx.EVT_BUTTON, self.OnCheck)
         btnSave.Bind(wx.EVT_BUTTON, self.OnSave)
@@ -513,12 +279,18 @@ class MainWindow (wx.Frame):
         btnSaveQuick.Bind(wx.EVT_BUTTON, self.OnSaveQuickConfig)
 
         # handle all the key inputs
-        self.AddFocusObject([self.configArea, self.configName, self.logArea, self.portConfig])
+        self.AddFocusObject([self.configArea, self.configName, self.logArea, self.portConfig,
+                             self.offsetConfig, self.runList])
         self.SetFocusObjectKeyHandle()
 
         # load the quick config files
         self.LoadQuickConfig()
 
+        # show the log lines at a fixed rate
+        self.logTimer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.FlushLog, self.logTimer)
+        self.logTimer.Start(LOG_FLUSH_TIME)
+
         self.Show(True)
 
     def OnSaveQuickConfig(self, e):
@@ -529,6 +301,8 @@ class MainWindow (wx.Frame):
         f = open(QUICK_LOAD_CONFIG_FILE, "w")
         f.write(json.dumps(array))
         f.close()
+        self.configCache.forget()
+        self.PrecompileQuickConfig()
         self.ShowMsg("Quick load config files saved.")
 
     def LoadQuickConfig (self):
@@ -543,6 +317,19 @@ class MainWindow (wx.Frame):
             except:
                 self.Log("failed load quick config, clearing the file...")
                 os.unlink(QUICK_LOAD_CONFIG_FILE)
+                return
+            self.PrecompileQuickConfig()
+
+    def PrecompileQuickConfig(self):
+        "check the quick load configs now, so F1-F8 can start them at once"
+        for item in self.configNameFx:
+            fileName = item.GetValue()
+            if not fileName:
+                continue
+            try:
+                self.configCache.load(fileName)
+            except Exception as e:
+                self.Log(str(e))
 
     def OnKeyUp(self, e):
         key = e.GetKeyCode()
@@ -558,9 +345,15 @@ class MainWindow (wx.Frame):
         fileName = self.configNameFx[key].GetValue()
         if not fileName:
             self.ShowMsg("Please input file name before using shortcut keys.")
-        if self.LoadConfigFile(fileName):
-            # load config file nicely, try to run the config file
-            self.OnStart(None)
+            return
+        # the cached config is only parsed again if the file has changed
+        try:
+            config, source = self.configCache.load(fileName)
+        except Exception as e:
+            self.ShowMsg(str(e))
+            return
+        self.ShowConfigFile(fileName, source)
+        self.StartConfig(config, source)
 
     def SaveConfig(self, hash, fileName):
         "Save hash into fileName"
@@ -604,17 +397,51 @@ class MainWindow (wx.Frame):
         if not config:
             self.ShowMsg("config parse error, please fix config and then start again")
             return
-        self.workThread.start(config, self.portConfig.GetValue().strip())
+        self.StartConfig(config, self.configArea.GetValue())
+
+    def StartConfig(self, config, source):
+        "start the checked 'config', whose text is 'source'"
+        offset = self.GetStartOffset()
+        if offset is None:
+            return
+        run = self.workThread.start(config, self.portConfig.GetValue().strip(),
+                                    offset, source, self.configName.GetValue())
+        if not run:
+            self.ShowMsg("failed to start the test, please check the log")
+
+    def GetStartOffset(self):
+        "get the offset (in seconds) to start the config at, None if wrong"
+        try:
+            offset = float(self.offsetConfig.GetValue().strip() or 0)
+        except ValueError:
+            offset = -1
+        if offset < 0:
+            self.ShowMsg("start offset should be a non-negative number of seconds")
+            return None
+        return offset
 
     def OnStop (self, e):
-        self.workThread.stop()
+        "stop the run selected in the run list, or all the runs"
+        index = self.runList.GetSelection()
+        if index == wx.NOT_FOUND or index >= len(self.runs):
+            self.workThread.stop()
+        else:
+            self.workThread.stop(self.runs[index])
+
+    def UpdateRunList(self):
+        self.runs = self.workThread.active_runs()
+        self.runList.Set([str(run) for run in self.runs])
 
     def ParseJson(self, str):
         "try to load the JSON string into hash"
+        started = TRACER.enabled and TRACER.now()
         try:
-            return json.loads(str)
+            data = json.loads(str)
         except:
-            return None
+            data = None
+        if started:
+            TRACER.add("ParseJson", started)
+        return data
 
     def ConvertJson(self, hash):
         return json.dumps(hash, indent=4)
@@ -628,35 +455,11 @@ class MainWindow (wx.Frame):
         if not check:
             # not do more checking
             return dataHash
-        if "description" not in dataHash:
-            self.ShowMsg("need 'description' entry!")
-            return None
-        if "channels" not in dataHash:
-            self.ShowMsg("need 'channels' entry!")
+        try:
+            check_config(dataHash)
+        except Exception as e:
+            self.ShowMsg(str(e))
             return None
-        channels = dataHash["channels"]
-        index_list = []
-        for chnl in channels:
-            value = channels[chnl]
-            if "channel" not in value:
-                self.ShowMsg("channel '%s' need key 'channel' as index" % \
-                             chnl)
-                return None
-            index = value["channel"]
-            if index in index_list:
-                self.ShowMsg("channel '%s' existed more than once!" % index)
-                return None
-            index_list.append(index)
-            if "signal" not in value:
-                self.ShowMsg("channel '%s' need key 'signal'")
-                return None
-            signal = value["signal"]
-            try:
-                signal = Signal.parseFromHash(signal)
-            except Exception, e:
-                self.ShowMsg("Failed parse signal: " + str(e))
-                return None
-            value["signal"] = signal
         return dataHash
 
     def LoadConfigFile(self, path):
@@ -674,17 +477,22 @@ class MainWindow (wx.Frame):
             self.ShowMsg("failed parse config file: '%s'" % fileName)
             return False
         # load OK
+        self.ShowConfigFile(path, self.ConvertJson(dataHash))
+        return True
+
+    def ShowConfigFile(self, path, data):
+        "show config file 'path' with content 'data' in the config area"
         self.configPath = path
         self.fileName = os.path.basename(path)
-        self.configArea.SetValue(self.ConvertJson(dataHash))
+        self.configArea.SetValue(data)
         self.configName.SetValue(self.fileName)
         self.Log("config file (%s) loaded." % self.fileName)
-        return True
 
     def OnCheck (self, e):
         configHash = self.GetConfig(check=True)
         if configHash:
-            self.ShowMsg("Config file check passed.")
+            self.ShowMsg("Config file check passed.\n\n" + \
+                         summarize_config(configHash))
 
     def OnOpen(self, e):
         dlg = wx.FileDialog(self,
@@ -709,6 +517,15 @@ class MainWindow (wx.Frame):
         dlg.ShowModal()
         dlg.Destroy()
 
+    def OnTrace(self, e):
+        "start or stop tracing, see Tracer"
+        if self.traceButton.IsChecked():
+            TRACER.start(TRACE_FILE)
+            self.Log("tracing started.")
+        else:
+            path = TRACER.stop()
+            self.Log("trace saved to '%s', open it in chrome://tracing." % path)
+
     def OnAbout(self, e):
         info = wx.AboutDialogInfo()
         info.Name = PROG_NAME
@@ -722,9 +539,47 @@ class MainWindow (wx.Frame):
         # Then we call wx.AboutBox giving it that info object
         wx.AboutBox(info)
 
+    def CheckUnfinishedRun(self):
+        "offer to resume the runs that were interrupted last time, if any"
+        for run in RunJournal.find_unfinished(JOURNAL_FILE):
+            started = datetime.datetime.fromtimestamp(run["time"]).ctime()
+            msg = "The run '%s' started at %s on '%s' was not finished. It " \
+                  "stopped at %s sec. Resume it from there?" % \
+                  (run.get("name", ""), started, run["port"], run["resume"])
+            dlg = wx.MessageDialog(self, msg, PROG_NAME, wx.YES_NO)
+            resume = dlg.ShowModal() == wx.ID_YES
+            dlg.Destroy()
+            # either way, the old run won't be offered again
+            self.journal.end(run["run"], resume and "resumed" or "abandoned")
+            if not resume:
+                continue
+            self.Log("resuming run %s at %s sec..." % \
+                         (run["run"], run["resume"]))
+            self.configArea.SetValue(run["config"])
+            self.configName.SetValue(run.get("name", ""))
+            self.portConfig.SetValue(run["port"])
+            self.offsetConfig.SetValue(str(run["resume"]))
+            self.OnStart(None)
+            # only this run is resumed, the next ones start from the beginning
+            self.offsetConfig.SetValue("0")
+
     def OnQuit(self, e):
         self.Close(True)
 
+    def OnClose(self, e):
+        "cleanups before the window is closed, either by Quit or close box"
+        # the runs switch their channels off when they finish, which has to
+        # be done before the ports are closed
+        if self.workThread.active_runs():
+            self.workThread.stop()
+        self.workThread.wait_done()
+        self.logTimer.Stop()
+        self.journal.close()
+        self.eventLog.close()
+        RelayController.close_all()
+        TRACER.stop()
+        self.Destroy()
+
 if __name__ == "__main__":
     app = wx.App(False)
     frame = MainWindow(None, PROG_NAME)
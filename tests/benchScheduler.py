@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+"""
+Timing benchmark of the WorkingThread scheduler, on simulated relay boards
+(see bio_sim.py) so no hardware is needed:
+
+    PYTHONPATH=. python tests/benchScheduler.py [--duration 5] [--output x.json]
+
+Each scenario is run twice: in virtual time, which gives the exact planned
+trace of relay transitions, then in real time. The real transitions are
+compared with the planned ones to get the lateness (as seen by the boards,
+so the serial writer threads are counted too):
+
+- late_p50/late_p99/late_max: lateness of the transitions, in seconds
+- drift: how the lateness grows over the run, in seconds per hour (slope of
+  the lateness over the planned time)
+- cpu: CPU seconds used by the process (all threads) during the run
+- events_per_sec: transitions per second of the run
+
+The "throughput" scenario only runs in virtual time, to see how many events
+per second the scheduler can handle at all. The results are printed as JSON,
+to compare the scheduler between changes.
+"""
+
+import os
+import sys
+import json
+import time
+import platform
+import threading
+import argparse
+
+from bio_core import Clock, RelayController, WorkingThread, check_config
+from bio_sim import Simulator, VirtualClock
+
+def pulse(on, off, cycle):
+    return {"sub_signals": [{"length": on, "state": 1},
+                            {"length": off, "state": 0}], "cycle": cycle}
+
+def dense_config(duration, precise):
+    "one channel with a 10ms pulse every 20ms"
+    return {"description": "dense", "precise": precise,
+            "channels": {"pulse": {"channel": 1,
+                                   "signal": pulse(0.01, 0.01,
+                                                   int(duration / 0.02))}}}
+
+def many_channels_config(duration):
+    "4 boards of 8 channels, each with its own period"
+    channels = {}
+    for port in range(4):
+        for channel in range(1, 9):
+            period = 0.1 + 0.013 * (port * 8 + channel)
+            channels["ch%s-%s" % (port, channel)] = {
+                "channel": channel, "port": "/dev/bench%s" % port,
+                "signal": pulse(period / 2, period / 2,
+                                int(duration / period))}
+    return {"description": "many-channels", "channels": channels}
+
+def nested_config(duration):
+    "a 50ms pulse nested in as many levels of 2 cycles as fit in 'duration'"
+    signal = pulse(0.02, 0.03, 1)
+    length = 0.05
+    while length * 2 <= duration:
+        signal = {"sub_signals": [signal], "cycle": 2}
+        length *= 2
+    return {"description": "nested",
+            "channels": {"nested": {"channel": 1, "signal": signal}}}
+
+def percentile(values, p):
+    "nearest-rank percentile of sorted 'values'"
+    if not values:
+        return 0
+    index = int(round(p / 100.0 * (len(values) - 1)))
+    return values[index]
+
+def slope(xs, ys):
+    "least squares slope of ys over xs"
+    n = len(xs)
+    if n < 2:
+        return 0
+    mx = sum(xs) / float(n)
+    my = sum(ys) / float(n)
+    var = sum([(x - mx) ** 2 for x in xs])
+    if not var:
+        return 0
+    return sum([(x - mx) * (y - my) for x, y in zip(xs, ys)]) / var
+
+def simulate(config, clock, logger, event_log=None):
+    """run 'config' on simulated boards with 'clock', returns (trace,
+    start_time, wall_time, cpu_time)"""
+    sim = Simulator(clock)
+    sim.install()
+    done = threading.Event()
+    def notify():
+        if not engine.active_runs():
+            done.set()
+    engine = WorkingThread(logger, None, notify, event_log, clock)
+    wall = time.time()
+    cpu = sum(os.times()[:2])
+    run = engine.start(config, "/dev/bench")
+    while not done.wait(1):
+        pass
+    RelayController.close_all()
+    cpu = sum(os.times()[:2]) - cpu
+    wall = time.time() - wall
+    return sim.trace(), run.start_time, wall, cpu
+
+def quiet_logger(msg, name="main"):
+    "only formats the lines, like a logger with nowhere to write"
+    return "%s: [%s] %s" % (time.time(), name, msg)
+
+def bench(name, config, logger=quiet_logger, event_log=None):
+    config = check_config(config)
+    planned, start, wall, cpu = simulate(config, VirtualClock(), quiet_logger)
+    trace, start, wall, cpu = simulate(config, Clock(), logger, event_log)
+    # compare the transitions of each relay in order
+    plans = {}
+    for item in planned:
+        plans.setdefault(item[1:3], []).append(item)
+    late = []
+    for item in trace:
+        plan = plans[item[1:3]].pop(0)
+        if plan[1:] != item[1:]:
+            raise Exception("%s: got %s but planned %s" % (name, item, plan))
+        late.append((plan[0], item[0] - start - plan[0]))
+    late.sort()
+    values = sorted([x[1] for x in late])
+    return {"scenario": name,
+            "transitions": len(trace),
+            "late_p50": percentile(values, 50),
+            "late_p99": percentile(values, 99),
+            "late_max": values and values[-1] or 0,
+            "drift": slope([x[0] for x in late], [x[1] for x in late]) * 3600,
+            "cpu": cpu,
+            "wall": wall,
+            "events_per_sec": len(trace) / wall}
+
+def bench_throughput(duration):
+    "events per second of the scheduler alone, in virtual time"
+    config = check_config(many_channels_config(duration * 100))
+    trace, start, wall, cpu = simulate(config, VirtualClock(), quiet_logger)
+    return {"scenario": "throughput", "transitions": len(trace),
+            "cpu": cpu, "wall": wall, "events_per_sec": len(trace) / wall}
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="scheduler timing benchmark")
+    parser.add_argument("--duration", type=float, default=5,
+                        help="length of each scenario in seconds")
+    parser.add_argument("--scenario", action="append",
+                        help="only run these scenarios")
+    parser.add_argument("--output", help="write the JSON results into a file")
+    args = parser.parse_args(argv)
+    duration = args.duration
+
+    log_file = open(os.devnull, "w")
+    def file_logger(msg, name="main"):
+        log_file.write("%s: [%s] %s\n" % (time.time(), name, msg))
+        log_file.flush()
+    def log_heavy():
+        from bio_core import EventLog
+        event_log = EventLog(os.devnull)
+        try:
+            return bench("log-heavy", many_channels_config(duration),
+                         file_logger, event_log)
+        finally:
+            event_log.close()
+
+    scenarios = [
+        ("dense", lambda: bench("dense", dense_config(duration, False))),
+        ("dense-precise", lambda: bench("dense-precise",
+                                        dense_config(duration, True))),
+        ("many-channels", lambda: bench("many-channels",
+                                        many_channels_config(duration))),
+        ("nested", lambda: bench("nested", nested_config(duration))),
+        ("log-heavy", log_heavy),
+        ("throughput", lambda: bench_throughput(duration)),
+    ]
+    results = []
+    for name, func in scenarios:
+        if args.scenario and name not in args.scenario:
+            continue
+        sys.stderr.write("running %s...\n" % name)
+        results.append(func())
+    log_file.close()
+
+    output = json.dumps({"python": platform.python_version(),
+                         "platform": sys.platform,
+                         "time": time.time(),
+                         "duration": duration,
+                         "results": results}, indent=4, sort_keys=True)
+    if args.output:
+        f = open(args.output, "w")
+        f.write(output + "\n")
+        f.close()
+    else:
+        print(output)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
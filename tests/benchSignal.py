@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+"""
+Benchmark of parsing and expanding signals, with generated configs of
+growing depth, fan-out and cycles:
+
+    PYTHONPATH=. python tests/benchSignal.py [--output now.json]
+    PYTHONPATH=. python tests/benchSignal.py --baseline old.json
+
+For each config it measures:
+
+- parse_sec: check_config() of the config loaded from JSON
+- first_event_sec: generate_event_queue() and the first event, which is
+  how long a run takes to get going
+- expand_sec: dump() of all the events, skipped if there are more than
+  --max-events of them
+- compile_sec/compile_kb: compile_config() of all the events into arrays
+  (see bio_compile.py) and their size, only with numpy and no more than
+  --max-events
+- parse_peak_kb/expand_peak_kb: peak memory of the above (python 3 only,
+  with tracemalloc)
+
+The times are the best of --repeat runs. With --baseline (the --output of an
+earlier run), every time more than --threshold times slower than the baseline
+is reported, and the exit code is 1, so scaling cliffs are caught early.
+"""
+
+import sys
+import json
+import time
+import platform
+import argparse
+try:
+    import tracemalloc
+except ImportError:
+    # python 2
+    tracemalloc = None
+
+from bio_core import WorkingThread, check_config
+import bio_compile
+
+# times shorter than this are too noisy to compare with the baseline
+MIN_TIME = 0.001
+
+def nested_signal(depth, fanout, cycle):
+    """'depth' levels of 'cycle' cycles, each level has the next level and
+    'fanout' - 1 atomic signals"""
+    signal = {"length": 1, "state": 1}
+    for i in range(depth):
+        subs = [signal]
+        for j in range(fanout - 1):
+            subs.append({"length": j % 7 + 1, "state": j % 2})
+        signal = {"sub_signals": subs, "cycle": cycle}
+    return signal
+
+def make_config(depth, fanout, cycle, channels=1):
+    config = {"description": "bench", "channels": {}}
+    for i in range(channels):
+        config["channels"]["ch%s" % (i + 1)] = {
+            "channel": i + 1, "port": "/dev/bench",
+            "signal": nested_signal(depth, fanout, cycle)}
+    # the way a config file is read
+    return json.dumps(config)
+
+def best_of(repeat, func):
+    "(best time, result) of calling func() 'repeat' times"
+    best = None
+    for i in range(repeat):
+        started = time.time()
+        result = func()
+        spent = time.time() - started
+        if best is None or spent < best:
+            best = spent
+    return best, result
+
+def peak_kb(func):
+    "peak memory (in KB) used while calling func(), None on python 2"
+    if not tracemalloc:
+        return None
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1] / 1024.0
+    finally:
+        tracemalloc.stop()
+
+def bench(name, text, args):
+    parse = lambda: check_config(json.loads(text))
+    parse_sec, config = best_of(args.repeat, parse)
+    engine = WorkingThread(lambda msg, name="main": None)
+    def first_event():
+        return engine.generate_event_queue(config).peek()
+    first_sec, event = best_of(args.repeat, first_event)
+    events = 0
+    for value in config["channels"].values():
+        events += value["signal"].event_count()
+    result = {"case": name, "source_kb": len(text) / 1024.0,
+              "events": events, "parse_sec": parse_sec,
+              "first_event_sec": first_sec, "expand_sec": None,
+              "parse_peak_kb": peak_kb(parse), "expand_peak_kb": None,
+              "compile_sec": None, "compile_kb": None}
+    if events <= args.max_events:
+        def expand():
+            return [x["signal"].dump() for x in config["channels"].values()]
+        result["expand_sec"] = best_of(args.repeat, expand)[0]
+        result["expand_peak_kb"] = peak_kb(expand)
+    if events <= args.max_events and bio_compile.numpy:
+        compile = lambda: bio_compile.compile_config(config)
+        result["compile_sec"], schedule = best_of(args.repeat, compile)
+        result["compile_kb"] = schedule.nbytes() / 1024.0
+    return result
+
+def cases():
+    "(name, config text) of all the generated configs"
+    for depth in [1, 2, 4, 8, 16, 32, 64]:
+        yield "depth-%s" % depth, make_config(depth, 2, 2)
+    for fanout in [10, 100, 1000, 10000]:
+        yield "fanout-%s" % fanout, make_config(1, fanout, 1)
+    for cycle in [1, 1000, 10**6, 10**9]:
+        yield "cycle-%s" % cycle, make_config(2, 2, cycle)
+    # a big config of every channel
+    yield "channels-8", make_config(4, 100, 10, 8)
+
+def check_baseline(results, path, threshold):
+    "returns the list of regressions against baseline file 'path'"
+    f = open(path, "r")
+    baseline = json.loads(f.read())
+    f.close()
+    old = dict([(x["case"], x) for x in baseline["results"]])
+    regressions = []
+    for result in results:
+        if result["case"] not in old:
+            continue
+        for key in ["parse_sec", "first_event_sec", "expand_sec",
+                    "compile_sec"]:
+            before = old[result["case"]].get(key)
+            now = result[key]
+            if before is None or now is None or now < MIN_TIME:
+                continue
+            if now > max(before, MIN_TIME) * threshold:
+                regressions.append("%s: %s %.6f -> %.6f (%.1fx)" % \
+                                       (result["case"], key, before, now,
+                                        now / max(before, MIN_TIME)))
+    return regressions
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="signal parse/expand "
+                                     "benchmark")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="take the best time of this many runs")
+    parser.add_argument("--max-events", type=int, default=10**6,
+                        help="don't expand signals of more events than this")
+    parser.add_argument("--output", help="write the JSON results into a file")
+    parser.add_argument("--baseline", help="compare with the JSON results of "
+                        "an earlier run")
+    parser.add_argument("--threshold", type=float, default=2.0,
+                        help="report times this many times slower than the "
+                             "baseline (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    results = []
+    for name, text in cases():
+        sys.stderr.write("running %s...\n" % name)
+        results.append(bench(name, text, args))
+    output = json.dumps({"python": platform.python_version(),
+                         "platform": sys.platform,
+                         "time": time.time(),
+                         "results": results}, indent=4, sort_keys=True)
+    if args.output:
+        f = open(args.output, "w")
+        f.write(output + "\n")
+        f.close()
+    else:
+        print(output)
+
+    if args.baseline:
+        regressions = check_baseline(results, args.baseline, args.threshold)
+        for line in regressions:
+            sys.stderr.write("REGRESSION %s\n" % line)
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+import sys
+from bio_core import WorkingThread, check_config
+import bio_compile
+from bio_compile import compile_config
+
+if not bio_compile.numpy:
+    print "numpy is not installed, skipped"
+    sys.exit(0)
+
+def make_config():
+    config = {"description": "compile", "channels": {
+            "pulse": {"channel": 1, "port": "/dev/a",
+                      "signal": {"sub_signals": [{"length": 0.1, "state": 1},
+                                                 {"length": 0.3, "state": 0}],
+                                 "cycle": 50}},
+            "nested": {"channel": 2, "port": "/dev/a",
+                       "signal": {"sub_signals": [
+                            {"sub_signals": [{"length": 3, "state": 1},
+                                             {"length": 2, "state": 1},
+                                             {"length": 5, "state": 0}],
+                             "cycle": 4},
+                            {"length": 7, "state": 1}], "cycle": 3}},
+            "other": {"channel": 1, "port": "/dev/b",
+                      "signal": {"length": 20, "state": 1}}}}
+    return check_config(config)
+
+def drain(queue):
+    events = []
+    while not queue.empty():
+        events.append(queue.pop())
+    return events
+
+print "testing compile_config()"
+config = make_config()
+engine = WorkingThread(lambda msg, name="main": None)
+lazy = drain(engine.generate_event_queue(config))
+schedule = compile_config(config)
+print "%s events, %s bytes" % (len(schedule), schedule.nbytes())
+assert schedule.peek() == lazy[0]
+# exactly the same events, in the same order
+assert drain(schedule) == lazy
+assert schedule.empty() and schedule.peek() is None
+
+print "testing compile_config() with offset"
+# offsets right at an event are left out, the lazy queue may round them
+# either way
+for offset in [0.05, 10.45, 20, 21.7, 60]:
+    lazy = drain(engine.generate_event_queue(config, offset))
+    compiled = drain(compile_config(config, offset))
+    assert len(lazy) == len(compiled)
+    for a, b in zip(lazy, compiled):
+        assert abs(a["length"] - b["length"]) < 1e-9
+        assert (a["name"], a["state"]) == (b["name"], b["state"])
+
+print "testing a compiled run"
+engine.compiled = True
+assert isinstance(engine.generate_event_queue(config),
+                  bio_compile.Schedule)
+try:
+    compile_config(config, max_events=10)
+    assert False, "should be too big"
+except Exception as e:
+    print e
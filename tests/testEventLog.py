@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+import os
+import time
+import shutil
+import tempfile
+import bio_core
+from bio_core import EventLog, RunJournal
+
+class FakeRun():
+    name = "run"
+    class clock():
+        @staticmethod
+        def now():
+            return 0
+event = {"length": 1, "name": "a", "port": "/dev/x", "channel": 1,
+         "state": 1, "late": 0}
+tmp = tempfile.mkdtemp()
+errors = []
+def logger(msg, name="main"):
+    errors.append(msg)
+
+print "testing rotating the event log"
+path = os.path.join(tmp, "events.csv")
+log = EventLog(path, size=100, count=2, logger=logger)
+for i in range(20):
+    log.append(FakeRun, event)
+    # let the writer take them one by one, so that it rotates many times
+    while not log.queue.empty():
+        time.sleep(0.001)
+log.close()
+print sorted(os.listdir(tmp))
+assert sorted(os.listdir(tmp)) == ["events.csv", "events.csv.1",
+                                   "events.csv.2"]
+assert not errors
+
+print "testing failing to write"
+path = os.path.join(tmp, "missing", "events.csv")
+log = EventLog(path, logger=logger)
+journal = RunJournal(os.path.join(tmp, "missing", "journal"), logger)
+log.append(FakeRun, event)
+run = journal.begin("{}", "/dev/x")
+while len(errors) < 2:
+    time.sleep(0.01)
+# the directory is back, the later records are written
+os.mkdir(os.path.join(tmp, "missing"))
+log.append(FakeRun, event)
+journal.end(run, "done")
+log.close()
+journal.close()
+print errors
+assert len(errors) == 2
+assert len(open(path).readlines()) == 2
+assert len(open(os.path.join(tmp, "missing", "journal")).readlines()) == 1
+
+print "testing the progress of a run"
+bio_core.JOURNAL_PROGRESS_TIME = 0.05
+path = os.path.join(tmp, "progress")
+journal = RunJournal(path, logger)
+run = journal.begin("{}", "/dev/x", 100)
+started = time.time()
+journal.watch(run, lambda: 100 + time.time() - started)
+time.sleep(0.3)
+# crashed, without an end record
+journal.close()
+resume = RunJournal.find_unfinished(path)[0]["resume"]
+print "resume at", resume
+assert 100.1 < resume < 100.4
+
+shutil.rmtree(tmp)
@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+
+from bio_core import Signal, EventQueue
+
+signal1 = Signal(sub_signals=[Signal(length=2, state=1),
+                              Signal(length=3, state=0)], cycle=3)
+signal2 = Signal(length=5, state=1)
+
+print "testing EventQueue merge"
+queue = EventQueue()
+queue.add_stream(signal1.iter_events())
+queue.add_stream(signal2.iter_events())
+result = []
+while not queue.empty():
+    result.append(queue.pop())
+for event in result:
+    print event
+
+expected = sorted(signal1.dump() + signal2.dump(), key=lambda x: x["length"])
+assert result == expected
+# same timestamp: the stream added first goes first
+assert result[1] == {"length": 5, "state": 0}
+assert result[2] == {"length": 5, "state": 1}
+
+print "testing EventQueue with a huge signal"
+queue = EventQueue()
+queue.add_stream(Signal(sub_signals=[signal1], cycle=10**9).iter_events())
+print queue.pop()
+print queue.peek()
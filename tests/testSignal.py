@@ -1,7 +1,9 @@
 #!/usr/bin/env python
 
-from bio_switch import Signal
+from bio_core import Signal, ConfigCache, check_config
+import os
 import json
+import tempfile
 
 signal1 = Signal(length=20, state=1)
 signal2 = Signal(length=30, state=0)
@@ -73,3 +75,98 @@ for config in [config1, config2, config3]:
     signal = Signal.parseFromHash(hash)
     print "parse result:"
     print signal
+
+print "testing iter_events()"
+assert list(signal5.iter_events()) == signal5.dump()
+assert list(signal5.iter_events(100)) == signal5.dump(100)
+# a huge cycle count should not be expanded before the first event
+huge = Signal(sub_signals=[signal1, signal2], cycle=10**9)
+events = huge.iter_events()
+print events.next()
+print events.next()
+print events.next()
+
+print "testing sub-second signals"
+pulse = Signal.parseFromHash({"sub_signals": [{"length": 0.01, "state": 1},
+                                              {"length": 0.09, "state": 0}],
+                              "cycle": 10})
+print pulse
+events = pulse.dump()
+assert len(events) == 20
+assert abs(events[-1]["length"] - 1.0) < 1e-9
+
+print "testing analytics"
+print "total length:", signal5.total_length()
+print "event count:", signal5.event_count()
+print "transitions:", signal5.transition_count()
+print "duty cycle:", signal5.duty_cycle()
+events = signal5.dump()
+assert signal5.total_length() == events[-1]["length"]
+assert signal5.event_count() == len(events)
+for event in events:
+    assert signal5.state_at(event["length"]) == event["state"]
+assert signal5.state_at(0) == 0
+assert signal5.state_at(0, initial=1) == 1
+print "analytics of a huge signal:", huge.total_length(), huge.duty_cycle()
+assert huge.state_at(50 * 10**8 + 20) == 1
+
+print "testing iter_events() with 'after'"
+for after in [0, 20, 21, 100, 447, 448]:
+    expected = [e for e in signal5.dump() if e["length"] > after]
+    assert list(signal5.iter_events(after=after)) == expected
+print huge.iter_events(after=50 * 10**8 + 20).next()
+
+print "testing shared sub-signals"
+# signal1 is used twice in signal5, and is not copied
+assert signal5.sub_signals[0] is signal1
+assert signal4.sub_signals[0] is signal1
+try:
+    signal1.length = 10
+    assert False, "signal should not be changed"
+except AttributeError:
+    pass
+# identical sub-signals are parsed into the same instance
+signal = Signal.parseFromHash(json.loads(config3))
+assert signal.sub_signals[0].sub_signals[0] is not signal.sub_signals[1]
+shared = Signal.parseFromHash({"sub_signals": [json.loads(config1),
+                                               json.loads(config1)]})
+assert shared.sub_signals[0] is shared.sub_signals[1]
+node = {"length": 1, "state": 1}
+for i in range(100):
+    # 2^100 atomic signals if every sub-signal was created on its own
+    node = {"sub_signals": [node, node], "cycle": 1}
+print Signal.parseFromHash(node).total_length()
+
+print "testing the options of check_config()"
+def channels():
+    return {"a": {"channel": 1, "signal": json.loads(config1)}}
+for options in [{"refresh": -1}, {"refresh": 0}, {"refresh": "60"},
+                {"refresh": True}, {"precise": 1}, {"precise": "yes"}]:
+    config = {"description": "options", "channels": channels()}
+    config.update(options)
+    try:
+        check_config(config)
+    except Exception as e:
+        print "refused %s: %s" % (options, e)
+        continue
+    assert False, "%s should be refused" % options
+check_config({"description": "options", "refresh": 0.5, "precise": True,
+              "channels": channels()})
+
+print "testing ConfigCache"
+path = tempfile.mktemp()
+cache = ConfigCache()
+def write_config(description):
+    f = open(path, "w")
+    f.write(json.dumps({"description": description,
+                        "channels": channels()}))
+    f.close()
+    # the same mtime each time, as within the mtime granularity of FAT
+    os.utime(path, (1000000000, 1000000000))
+write_config("a")
+config, source = cache.load(path)
+assert cache.load(path)[0] is config
+# the same size and mtime, but not the same content
+write_config("b")
+assert cache.load(path)[0]["description"] == "b"
+os.unlink(path)
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+import time
+import threading
+from bio_core import RelayController, WorkingThread, check_config
+from bio_sim import FrameDecoder, SimulatedBoard, Simulator, VirtualClock
+
+print "testing FrameDecoder"
+decoder = FrameDecoder()
+frames = RelayController.FRAMES
+data = b"\x00" + frames[(1, 1)] + frames[(8, 0)] + frames[(2, 1)][:3]
+assert decoder.feed(data) == [(1, 1), (8, 0)]
+assert decoder.feed(frames[(2, 1)][3:]) == [(2, 1)]
+assert decoder.errors == 1
+# bad checksum
+assert decoder.feed(b"\xff\x01\x01\x05\xee") == []
+
+print "testing a simulated run"
+config = check_config({
+    "description": "simulated",
+    "channels": {
+        "pump": {"channel": 1,
+                 "signal": {"sub_signals": [{"length": 3600, "state": 1},
+                                            {"length": 1800, "state": 0}],
+                            "cycle": 48}},
+        "light": {"channel": 2, "port": "/dev/board2",
+                  "signal": {"length": 43200, "state": 1}},
+    }})
+sim = Simulator(VirtualClock())
+sim.install()
+done = threading.Event()
+def notify():
+    if not engine.active_runs():
+        done.set()
+engine = WorkingThread(lambda msg, name="main": None, notify=notify,
+                       clock=sim.clock)
+started = time.time()
+run = engine.start(config, "/dev/board1", name="simulated run")
+# the run keeps the name it was given, not the one of a channel
+assert run.name == "simulated run"
+done.wait(60)
+RelayController.close_all()
+trace = sim.trace()
+print "simulated %s sec in %.3f sec" % (sim.clock.now(), time.time() - started)
+for item in trace[:4] + trace[-3:]:
+    print item
+# every cycle switches the pump on and off, then both are switched off
+assert len(trace) == 48 * 2 + 1 + 1
+assert trace[0] == (3600, "/dev/board1", 1, 1)
+assert trace[1] == (5400, "/dev/board1", 1, 0)
+assert (43200, "/dev/board2", 2, 1) in trace
+assert trace[-1][0] == 48 * 5400
+
+print "testing reconnecting a port"
+class FlakyBoard(SimulatedBoard):
+    "fails on the second write, as if unplugged"
+    writes = 0
+    def write (self, data):
+        self.writes += 1
+        if self.writes == 2:
+            raise IOError("unplugged")
+        return SimulatedBoard.write(self, data)
+boards = []
+def opener(port, baudrate):
+    # the port can't be opened again at first
+    boards.append(None)
+    if len(boards) == 2:
+        raise IOError("no such port")
+    boards[-1] = FlakyBoard(port)
+    return boards[-1]
+RelayController.opener = staticmethod(opener)
+control = RelayController(lambda msg, name="main": None, "/dev/flaky")
+try:
+    control.send_cmd(1, 1)
+    assert False, "the reconnect should have failed"
+except IOError:
+    pass
+assert control.serial is None
+assert control.states[1] == 0
+# the port is back
+control.send_cmd(1, 1)
+assert len(boards) == 3
+assert boards[-1].states[1] == 1
+assert control.states[1] == 1
+
+print "testing channels on the same relay"
+config = check_config({
+    "description": "same relay",
+    "channels": {"a": {"channel": 1, "signal": {"length": 1, "state": 1}},
+                 "b": {"channel": 1, "port": "/dev/board1",
+                       "signal": {"length": 1, "state": 1}}}})
+engine = WorkingThread(lambda msg, name="main": None, clock=VirtualClock())
+# "a" is on /dev/board1 too once the default port is set
+assert engine.start(config, "/dev/board1") is None
+assert not engine.active_runs()
+
+print "testing resuming a run at zero"
+sim = Simulator(VirtualClock(speed=1))
+sim.install()
+config = check_config({
+    "description": "restart",
+    "channels": {"a": {"channel": 1, "signal": {
+        "sub_signals": [{"length": 0.1, "state": 0}, {"length": 0.1, "state": 1},
+                        {"length": 10, "state": 0}]}}}})
+engine = WorkingThread(lambda msg, name="main": None, clock=sim.clock)
+run = engine.start(config, "/dev/board1")
+time.sleep(0.3)
+RelayController.sync_all()
+assert sim.boards["/dev/board1"].states[1] == 1
+# the relay is off at the start of the config, so it's switched off again
+engine.resume(run, 0)
+RelayController.sync_all()
+assert sim.boards["/dev/board1"].states[1] == 0
+engine.stop()
+engine.wait_done()
+RelayController.close_all()